@@ -0,0 +1,339 @@
+import youtube
+from youtube import HTTPError
+import aiohttp
+import asyncio
+import os
+from tempfile import mkstemp
+from googleapicfg import key, client_id, client_secret
+
+__all__ = ["download_audio", "resolve_stream", "convert", "convert_many", "convert_stream", "iter_playlist",
+           "get_playlist", "iter_videos_from_channel", "refresh_token", "gather_limited", "close", "HTTPError"]
+
+# Asyncio counterparts of the functions in youtube.py, sharing its stream cache and login.
+# HTTP requests and ffmpeg processes don't block the event loop; the stream cache (SQLite), the login (keyring)
+# and resolving a stream which isn't cached (pafy) run in the default executor.
+
+_api_url = 'https://www.googleapis.com/youtube/v3/'
+_token_url = 'https://accounts.google.com/o/oauth2/token'
+
+
+def _session():
+    """Return the aiohttp session of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    session = _session.sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30),
+                                        connector=aiohttp.TCPConnector(limit=_session.connections))
+        _session.sessions[loop] = session
+    return session
+
+
+_session.sessions = dict()
+_session.connections = 100
+
+
+async def close():
+    """Close the HTTP session of the running event loop."""
+    session = _session.sessions.pop(asyncio.get_running_loop(), None)
+    if session:
+        await session.close()
+
+
+def _raise_for_status(response):
+    if response.status >= 400:
+        raise HTTPError("{0} {1} for url: {2}".format(response.status, response.reason, response.url))
+
+
+async def _in_executor(func, *args):
+    """Return the result of the blocking call func(*args), run in the default executor."""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def gather_limited(aws, limit: int):
+    """Await every awaitable in `aws` with at most `limit` of them running at the same time,
+    and return their results in order."""
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[run(aw) for aw in aws])
+
+
+async def _take_token():
+    """Wait until the rate limit of youtube._api, shared with the threads, lets one more request through."""
+    wait = youtube._api.try_token()
+    while wait:
+        await asyncio.sleep(wait)
+        wait = youtube._api.try_token()
+
+
+async def _api_get(endpoint: str, params: dict):
+    # Throws HTTPError
+    """Send a Data API request scheduled, charged and retried like the requests of youtube.YoutubeDataApi."""
+    api = youtube._api
+    retries = youtube.YoutubeDataApi.retries
+    with youtube.timed_stage('api', endpoint=endpoint) as event:
+        event['quota'] = 0
+        for attempt in range(retries + 1):
+            await _take_token()
+            event['quota'] += api.charge(endpoint)
+            try:
+                async with _session().get(_api_url + endpoint, params=params) as response:
+                    reason = None
+                    if response.status == 403:
+                        try:
+                            reason = api.error_reason(await response.json(content_type=None))
+                        except ValueError:
+                            pass
+                    delay = api.delay_for(response.status, response.headers, reason, attempt)
+                    if delay is None or attempt == retries:
+                        if response.status == 401:
+                            # Lost authorization, log out
+                            await _in_executor(youtube.logout)
+                        if response.status != 200:
+                            _raise_for_status(response)
+                        return await response.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+                delay = api.backoff(attempt)
+            event['retries'] = attempt + 1
+            await asyncio.sleep(delay)
+
+
+async def _iter_pages(endpoint: str, get_params: dict):
+    response = await _api_get(endpoint, get_params)
+    yield response
+    while 'nextPageToken' in response:
+        get_params = dict(get_params, pageToken=response['nextPageToken'])
+        response = await _api_get(endpoint, get_params)
+        yield response
+
+
+async def iter_playlist(playlistId: str):
+    """Asynchronously yield the videoIds contained in the youtube playlist identified by `playlistId`,
+    one page at a time, as the pages are received.
+    Throws HTTPError in case of failure."""
+
+    get_params = {
+        'part': 'contentDetails',
+        'playlistId': playlistId,
+        'fields': 'items/contentDetails,nextPageToken,pageInfo',
+        'maxResults': 50,
+        'key': key
+    }
+
+    #Loading the stored login may read the keyring and refresh the token
+    if await _in_executor(youtube.current_user):
+        get_params['access_token'] = youtube.login._access_token
+
+    async for response in _iter_pages("playlistItems", get_params):
+        for item in response['items']:
+            yield item['contentDetails']['videoId']
+
+
+async def get_playlist(playlistId: str):
+    """Return a list of videoIds containted in the youtube playlist identified by `playlistId`.
+    Throws HTTPError in case of failure."""
+
+    return [videoId async for videoId in iter_playlist(playlistId)]
+
+
+async def iter_videos_from_channel(channelId):
+    """Asynchronously yield the videoIds publicly uploaded to a channel, one page at a time,
+    from the uploads playlist of the channel (see youtube.iter_videos_from_channel).
+    Throws HTTPError in case of failure."""
+
+    get_params = {
+        'part': 'contentDetails',
+        'id': channelId,
+        'fields': 'items/contentDetails/relatedPlaylists/uploads',
+        'key': key
+    }
+
+    channels = (await _api_get("channels", get_params))['items']
+    if channels:
+        async for videoId in iter_playlist(channels[0]['contentDetails']['relatedPlaylists']['uploads']):
+            yield videoId
+
+
+async def refresh_token():
+    """Refresh the access token of the logged in user, and schedule the next refresh
+    on the running event loop. Return False if the user had to be logged out."""
+
+    import keyring
+    loop = asyncio.get_running_loop()
+    if not await _in_executor(youtube.current_user):
+        return False
+
+    refresh = await _in_executor(keyring.get_password, youtube._app_name, youtube.login.username)
+    if not refresh:
+        await _in_executor(youtube.logout)
+        return False
+
+    async with _session().post(_token_url, data={
+            'refresh_token': refresh,
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'refresh_token'}) as response:
+        if response.status != 200:
+            await _in_executor(youtube.logout)
+            return False
+        token = await response.json()
+
+    with youtube.login._lock:
+        youtube.login._access_token = token['access_token']
+        #The event loop refreshes the token from now on
+        if youtube.login._access_token_refresh_timer:
+            youtube.login._access_token_refresh_timer.cancel()
+            youtube.login._access_token_refresh_timer = None
+    loop.call_later(token['expires_in'] * 0.95, lambda: asyncio.ensure_future(refresh_token()))
+    return True
+
+
+async def resolve_stream(videoId: str, cached: bool=True, target_format: str=None, bitrate: "bits per second"=None):
+    # Throws IOError, ValueError, RuntimeError
+    """See youtube.resolve_stream. Cache misses are resolved by pafy in the default executor."""
+
+    videoId = youtube._video_id(videoId)
+    if cached:
+        info = await _in_executor(youtube._cached_stream, videoId, target_format, bitrate)
+        if info:
+            return info
+    return await _in_executor(youtube.resolve_stream, videoId, False, target_format, bitrate)
+
+
+async def _download_url(url: str, filename: str):
+    async with _session().get(url) as response:
+        _raise_for_status(response)
+        with open(filename, 'xb') as f:
+            async for chunk in response.content.iter_chunked(youtube._download_url.chunk_size):
+                f.write(chunk)
+
+
+async def download_audio(videoId: str, filename: str="", target_format: str=None, bitrate: "bits per second"=None):
+    # Throws IOError, ValueError, RuntimeError
+    """Download the audio from the youtube video identified by `videoId` (or its URL)
+    and save it in the file `filename`.
+    If `filename` already exists, the function fails
+    If `filename` is not specified, a tmp file is created.
+    The stream is chosen for a later conversion to `target_format` at `bitrate`, see youtube.select_stream.
+    Returns tuple(video title, name of the file written, stream extension)."""
+
+    if filename == "":
+        tmp = mkstemp()
+        os.close(tmp[0])
+        os.remove(tmp[1])
+        filename = tmp[1]
+    elif os.path.exists(filename):
+        raise IOError("the file already exists")
+
+    videoId = youtube._video_id(videoId)
+    info = await _in_executor(youtube._cached_stream, videoId, target_format, bitrate)
+    if info:
+        try:
+            await _download_url(info['url'], filename)
+            return info['title'], filename, info['extension']
+        except HTTPError:
+            #The cached url may have been revoked before its expiry time; resolve it again
+            await _in_executor(youtube._uncache_stream, videoId)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    info = await resolve_stream(videoId, False, target_format, bitrate)
+    await _download_url(info['url'], filename)
+    return info['title'], filename, info['extension']
+
+
+async def _ffmpeg(args: list, **kwargs):
+    return await asyncio.create_subprocess_exec('ffmpeg', '-loglevel', 'quiet', '-n', *args,
+                                                creationflags=youtube._ffmpeg.creationflags, **kwargs)
+
+
+async def convert(filename: str, output: str, start_time: "seconds"=0, duration: "seconds"=-1,
+                  bitrate: "bits per second"=None):
+    # Throws IOError, RuntimeError
+    """See youtube.convert."""
+
+    fmt = youtube._prepare_output(output)
+    info = {'codec': None, 'bitrate': None}
+    if youtube.convert.remux:
+        info = await _in_executor(youtube.probe, filename)
+    p = await _ffmpeg(['-i', filename] + youtube._trim_args(start_time, duration) +
+                      youtube._output_args(fmt, info['codec'], output, bitrate, source_bitrate=info['bitrate']))
+    if await p.wait() != 0:
+        raise RuntimeError("ffmpeg failed with code " + str(p.returncode))
+
+
+async def convert_many(filename: str, outputs: list, bitrate: "bits per second"=None, tags: dict=None):
+    # Throws IOError, RuntimeError
+    """See youtube.convert_many, whose items of `outputs` are supported; cover art and normalizing aren't."""
+
+    targets = [(output, 0, -1, None, None) if isinstance(output, str) else (tuple(output) + (None, None))[:5]
+               for output in outputs]
+    formats = [youtube._prepare_output(target[0]) for target in targets]
+    info = {'codec': None, 'bitrate': None}
+    if youtube.convert.remux:
+        info = await _in_executor(youtube.probe, filename)
+    args = ['-i', filename]
+    for (output, start_time, duration, output_tags, rate), fmt in zip(targets, formats):
+        args += youtube._trim_args(start_time, duration) + \
+                youtube._output_args(fmt, info['codec'], output, rate or bitrate,
+                                     dict(tags or {}, **(output_tags or {})), source_bitrate=info['bitrate'])
+    p = await _ffmpeg(args)
+    if await p.wait() != 0:
+        for target in targets:
+            if os.path.exists(target[0]):
+                os.remove(target[0])
+        raise RuntimeError("ffmpeg failed with code " + str(p.returncode))
+
+
+async def _pipe_url(url: str, output: str, args: list):
+    async with _session().get(url) as response:
+        _raise_for_status(response)
+        p = await _ffmpeg(['-i', 'pipe:0'] + args, stdin=asyncio.subprocess.PIPE)
+        try:
+            try:
+                async for chunk in response.content.iter_chunked(youtube._download_url.chunk_size):
+                    p.stdin.write(chunk)
+                    await p.stdin.drain()
+                p.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                #ffmpeg exited early, its return code tells why
+                pass
+            if await p.wait() != 0:
+                raise RuntimeError("ffmpeg failed with code " + str(p.returncode))
+        except BaseException:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            if os.path.exists(output):
+                os.remove(output)
+            raise
+
+
+async def convert_stream(videoId: str, output: str, start_time: "seconds"=0, duration: "seconds"=-1,
+                         bitrate: "bits per second"=None):
+    # Throws IOError, ValueError, RuntimeError
+    """See youtube.convert_stream."""
+
+    fmt = youtube._prepare_output(output)
+    args = youtube._trim_args(start_time, duration)
+    videoId = youtube._video_id(videoId)
+    info = await _in_executor(youtube._cached_stream, videoId, fmt, bitrate)
+    if info:
+        try:
+            await _pipe_url(info['url'], output, args + youtube._output_args(fmt, info['codec'], output, bitrate,
+                                                                             source_bitrate=info['bitrate']))
+            return info['title']
+        except HTTPError:
+            #The cached url may have been revoked before its expiry time; resolve it again
+            await _in_executor(youtube._uncache_stream, videoId)
+
+    info = await resolve_stream(videoId, False, fmt, bitrate)
+    await _pipe_url(info['url'], output, args + youtube._output_args(fmt, info['codec'], output, bitrate,
+                                                                     source_bitrate=info['bitrate']))
+    return info['title']
@@ -0,0 +1,403 @@
+import youtube
+import argparse
+import contextlib
+import functools
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Benchmarks for the download/convert pipeline, run against local stand-ins for
+# the YouTube Data API and the stream servers, so results only depend on this machine.
+#
+# Usage: python bench.py [--sizes 10 50] [--workers 2:1 8:4] [--output results.json] [--compare old.json]
+#                       [--import-budget 0.5]
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class FakeDataApi(BaseHTTPRequestHandler):
+    """Paginated playlistItems, search, channels and playlists listings of synthetic videos, with ETags.
+    Playlist 'PL<n>' and channel 'UC<n>' (whose uploads playlist is 'UU<n>') contain n videos
+    with ids 'v00000', 'v00001', ..."""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    page_size = 50
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        endpoint = url.path.rsplit('/', 1)[-1]
+        size = int((params.get('playlistId') or params.get('channelId') or params.get('id') or 'PL0')
+                   .split(',')[0][2:] or 0)
+        start = int(params.get('pageToken', 0))
+        page = range(start, min(start + self.page_size, size))
+        if endpoint == 'playlistItems':
+            items = [{'contentDetails': {'videoId': 'v%05d' % i}} for i in page]
+        elif endpoint == 'search':
+            items = [{'id': {'kind': 'youtube#video', 'videoId': 'v%05d' % i}} for i in page]
+        elif endpoint == 'channels':
+            items = [{'contentDetails': {'relatedPlaylists': {'uploads': 'UU' + params['id'][2:]}}}]
+            page = range(0)
+        elif endpoint == 'playlists':
+            items = [{'id': playlistId, 'snippet': {'title': 'Playlist ' + playlistId}}
+                     for playlistId in params['id'].split(',')]
+            page = range(0)
+        else:
+            self.send_error(404)
+            return
+        response = {'items': items, 'pageInfo': {'totalResults': size, 'resultsPerPage': self.page_size}}
+        if page and page.stop < size:
+            response['nextPageToken'] = str(page.stop)
+        body = json.dumps(response).encode()
+        etag = '"{0:x}"'.format(hash(body) & 0xffffffff)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeStreamServer(BaseHTTPRequestHandler):
+    """Serves the files in `files` (name -> bytes) at /<name>, with Range support."""
+
+    protocol_version = 'HTTP/1.1'
+    files = dict()
+
+    def log_message(self, *args):
+        pass
+
+    def _file(self):
+        return self.files.get(urlparse(self.path).path.lstrip('/'))
+
+    def do_HEAD(self):
+        data = self._file()
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self._file()
+        if data is None:
+            self.send_error(404)
+            return
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}/'.format(server.server_address[1])
+
+
+def make_fixtures(directory: str, durations):
+    """Generate pink noise tracks of the given durations (in seconds) as opus/webm and aac/m4a,
+    the two kinds of audio streams youtube serves. Existing fixtures are reused."""
+    os.makedirs(directory, exist_ok=True)
+    fixtures = []
+    for duration in durations:
+        for extension, codec in (('webm', 'libopus'), ('m4a', 'aac')):
+            name = 'noise{0}.{1}'.format(duration, extension)
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                subprocess.check_call(['ffmpeg', '-loglevel', 'quiet', '-y', '-f', 'lavfi',
+                                       '-i', 'anoisesrc=c=pink:a=0.3:d={0}'.format(duration),
+                                       '-c:a', codec, '-b:a', '128k', path])
+            fixtures.append((name, extension))
+    return fixtures
+
+
+def summarize(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1]
+    }
+
+
+class Measure:
+    """Measure wall time, CPU utilisation (including child processes such as ffmpeg)
+    and peak RSS of this process over a `with` block."""
+
+    def __enter__(self):
+        self.rss = self._rss()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self.times = os.times()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        end = os.times()
+        self._stop.set()
+        self._sampler.join()
+        cpu = sum(end[:4]) - sum(self.times[:4])
+        self.cpu_utilisation = cpu / (self.wall * (os.cpu_count() or 1)) if self.wall else 0.0
+        self.peak_rss_kb = max(self.rss, self._rss())
+
+    def _sample(self):
+        while not self._stop.wait(0.05):
+            self.rss = max(self.rss, self._rss())
+
+    @staticmethod
+    def _rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError, AttributeError):
+            #ru_maxrss is the peak over the life of the process, not of the block
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+
+def timed(samples: list, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def load_cli():
+    spec = importlib.util.spec_from_file_location('yt_downloader',
+                                                  os.path.join(os.path.dirname(__file__), 'yt-downloader.py'))
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)
+    return cli
+
+
+def bench_api(size: int, repeat: int):
+    """Enumerate a playlist and a channel of `size` videos from the fake Data API."""
+    runs = []
+    for scenario, func, arg in (('api-playlist', youtube.get_playlist, 'PL{0}'.format(size)),
+                                ('api-channel', youtube.get_videos_from_channel, 'UC{0}'.format(size))):
+        samples = []
+        with Measure() as m:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                assert len(func(arg)) == size
+                samples.append(time.perf_counter() - start)
+        runs.append({'scenario': scenario, 'playlist_size': size, 'latency': summarize(samples),
+                     'wall': m.wall, 'cpu_utilisation': m.cpu_utilisation, 'peak_rss_kb': m.peak_rss_kb})
+    return runs
+
+
+def bench_import(repeat: int):
+    """Import youtube in `repeat` fresh interpreters, and check that the import has no side effect:
+    no thread started and none of the modules which are only needed later (pafy, keyring) imported."""
+    code = ('import sys, threading, time\n'
+            'start = time.perf_counter()\n'
+            'import youtube\n'
+            'print(time.perf_counter() - start)\n'
+            'print(",".join(m for m in ("pafy", "keyring", "webbrowser") if m in sys.modules))\n'
+            'print(threading.active_count() - 1)\n')
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(__file__) or '.',
+                                         timeout=60).decode().split('\n')
+        samples.append(float(output[0]))
+    return {'scenario': 'import', 'latency': summarize(samples), 'wall': summarize(samples)['p50'],
+            'eager_imports': [m for m in output[1].split(',') if m], 'threads': int(output[2])}
+
+
+def bench_pipeline(cli, stream_url: str, fixtures, size: int, download_workers: int, transcode_workers: int,
+                   target_format: str, pipe: bool, workdir: str):
+    """Download and convert a playlist of `size` videos cycling through `fixtures`."""
+    out = tempfile.mkdtemp(dir=workdir)
+    files = FakeStreamServer.files
+    videoIds = []
+    for i in range(size):
+        name, extension = fixtures[i % len(fixtures)]
+        videoId = 'b{0}-{1:05d}'.format(int(time.time() * 1000), i)
+        youtube._cache_stream({'videoId': videoId, 'title': videoId, 'url': stream_url + name,
+                               'extension': extension, 'bitrate': 128000, 'expires': time.time() + 3600})
+        videoIds.append(videoId)
+    total_bytes = sum(len(files[fixtures[i % len(fixtures)][0]]) for i in range(size))
+
+    stages = {'download': [], 'convert': [], 'pipe': []}
+    originals = youtube.download_audio, youtube.convert, youtube.convert_stream
+    youtube.download_audio = timed(stages['download'], youtube.download_audio)
+    youtube.convert = timed(stages['convert'], youtube.convert)
+    youtube.convert_stream = timed(stages['pipe'], youtube.convert_stream)
+    cli.work_on_song.success_count = 0
+    filename = os.path.join(out, '*.' + target_format)
+    try:
+        with Measure() as m, contextlib.redirect_stdout(io.StringIO()):
+            if pipe:
+                download = functools.partial(cli.pipe_song, filename=filename, target_format=target_format)
+                cli.run_pipeline(videoIds, lambda videoId: download(videoId) and None, lambda _: None,
+                                 download_workers, transcode_workers, transcode_workers)
+            else:
+                cli.run_pipeline(videoIds, cli.fetch_song,
+                                 functools.partial(cli.finish_song, filename=filename, target_format=target_format),
+                                 download_workers, transcode_workers, transcode_workers)
+    finally:
+        youtube.download_audio, youtube.convert, youtube.convert_stream = originals
+        shutil.rmtree(out, ignore_errors=True)
+
+    return {
+        'scenario': 'pipe' if pipe else 'pipeline',
+        'playlist_size': size,
+        'download_workers': download_workers,
+        'transcode_workers': transcode_workers,
+        'format': target_format,
+        'succeeded': cli.work_on_song.success_count,
+        'wall': m.wall,
+        'tracks_per_min': cli.work_on_song.success_count * 60 / m.wall if m.wall else 0.0,
+        'mb_per_s': total_bytes / (1 << 20) / m.wall if m.wall else 0.0,
+        'cpu_utilisation': m.cpu_utilisation,
+        'peak_rss_kb': m.peak_rss_kb,
+        'stages': {stage: summarize(samples) for stage, samples in stages.items() if samples}
+    }
+
+
+def run_key(run: dict):
+    return tuple(run.get(k) for k in ('scenario', 'playlist_size', 'download_workers', 'transcode_workers',
+                                      'format'))
+
+
+def compare(old: dict, new: dict):
+    """Print the wall time of every run of `new` relative to the same run in `old`."""
+    baseline = {run_key(run): run for run in old['runs']}
+    for run in new['runs']:
+        previous = baseline.get(run_key(run))
+        if previous and previous['wall']:
+            print('{0:<60} {1:8.3f}s -> {2:8.3f}s ({3:+.1%})'.format(
+                ' '.join(str(k) for k in run_key(run) if k is not None), previous['wall'], run['wall'],
+                run['wall'] / previous['wall'] - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the download/convert pipeline against local servers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50], help='playlist sizes')
+    parser.add_argument('--workers', nargs='+', default=['4:2', '8:{0}'.format(os.cpu_count() or 1)],
+                        help='download_workers:transcode_workers combinations')
+    parser.add_argument('--format', default='mp3', help='target format')
+    parser.add_argument('--durations', type=int, nargs='+', default=[30, 180], help='fixture durations (seconds)')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='fake Data API latency (seconds)')
+    parser.add_argument('--api-sizes', type=int, nargs='+', default=[500, 5000], help='sizes of enumerated playlists')
+    parser.add_argument('--pipe', action='store_true', help='also benchmark piped conversion')
+    parser.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'yt-downloader-bench'),
+                        help='directory of the generated fixture audio files')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument('--import-budget', type=float, default=0.5,
+                        help='fail if importing youtube takes longer (seconds) or has side effects')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='yt-downloader-bench-')
+    #Keep the user's cache out of the measurements
+    youtube._cache_dir = workdir
+    youtube._cache_db.connection = None
+    FakeDataApi.latency = args.api_latency
+    _, api_url = serve(FakeDataApi)
+    _, stream_url = serve(FakeStreamServer)
+    youtube._api._base = api_url
+    #Keep the user's login out of the measurements
+    youtube.login._loaded = True
+    fixtures = make_fixtures(args.fixtures, args.durations)
+    for name, _ in fixtures:
+        with open(os.path.join(args.fixtures, name), 'rb') as f:
+            FakeStreamServer.files[name] = f.read()
+    cli = load_cli()
+
+    results = {'python': sys.version.split()[0], 'cpu_count': os.cpu_count(), 'timestamp': time.time(), 'runs': []}
+    try:
+        results['revision'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                                      cwd=os.path.dirname(__file__) or '.',
+                                                      stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    code = 0
+    try:
+        run = bench_import(5)
+        results['runs'].append(run)
+        print('import {wall:.3f}s eager={eager_imports} threads={threads}'.format(**run))
+        if run['wall'] > args.import_budget or run['eager_imports'] or run['threads']:
+            print('FAIL: importing youtube exceeds the budget of {0}s or has side effects'.format(args.import_budget))
+            code = 1
+        for size in args.api_sizes:
+            results['runs'] += bench_api(size, 3)
+        for size in args.sizes:
+            for workers in args.workers:
+                download_workers, transcode_workers = (int(n) for n in workers.split(':'))
+                for pipe in ((False, True) if args.pipe else (False,)):
+                    run = bench_pipeline(cli, stream_url, fixtures, size, download_workers, transcode_workers,
+                                         args.format, pipe, workdir)
+                    results['runs'].append(run)
+                    print('{scenario} size={playlist_size} workers={download_workers}:{transcode_workers} '
+                          '{wall:.2f}s {tracks_per_min:.1f} tracks/min {mb_per_s:.2f} MB/s '
+                          'cpu={cpu_utilisation:.0%} rss={peak_rss_kb}kB'.format(**run))
+    finally:
+        youtube._cache_db.connection.close()
+        youtube._cache_db.connection = None
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    return code
+
+
+if __name__ == "__main__":
+    code = main()
+    youtube.__end__()
+    exit(code)
@@ -1,25 +1,100 @@
-import pafy
-import keyring
 from nap.url import Url
+import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 import os
-from subprocess import Popen as popen
-from tempfile import mkstemp
+import shutil
+import sqlite3
+import json
+import re
+import hashlib
+import time
+from subprocess import Popen as popen, PIPE
+from tempfile import mkstemp, mkdtemp
 import socket
 import string
 import random
 from urllib.parse import parse_qs, urlparse
+from email.utils import parsedate_to_datetime
 import threading
+from multiprocessing.pool import ThreadPool
 from collections import defaultdict
-import webbrowser
+from contextlib import contextmanager
 import atexit
 from googleapicfg import key, client_id, client_secret
 
-__all__ = ["download_audio", "search", "convert", "login", "make_filename", "get_playlist", "get_my_playlists",
-           "get_playlist_title", "logout", "HTTPError"]
+__all__ = ["download_audio", "resolve_stream", "select_stream", "search", "convert", "convert_many", "convert_parallel",
+           "remux", "download_cover", "split", "loudness", "measure_loudness", "probe_chapters", "parse_timestamps",
+           "parse_cue", "convert_stream", "store_key", "store_get", "store_add", "store_gc", "materialize", "probe",
+           "login", "current_user", "make_filename", "get_playlist", "iter_playlist", "get_playlists",
+           "get_videos_from_channel", "iter_videos_from_channel", "get_my_playlists", "get_playlist_title",
+           "get_playlist_titles", "get_video_details", "get_video_durations", "logout", "HTTPError", "add_listener",
+           "remove_listener", "emit", "tracking", "timed_stage", "JsonLinesExporter", "PrometheusExporter"]
 
 
 class YoutubeDataApi(Url):
+    """Every request goes through one keep-alive session whose connection pool
+    is shared by all API helpers and all threads.
+    Requests are scheduled centrally: each one takes a token from a bucket refilled at
+    YoutubeDataApi.rate requests per second, is charged the quota units of its endpoint
+    (see quota), and is retried with jittered exponential backoff on 429, 5xx,
+    rate limit 403 and connection errors, waiting at least as long as Retry-After asks.
+    Responses with an ETag are kept in the on-disk cache, see get_cached."""
+
+    def __init__(self, base_url: str, **default_kwargs):
+        super().__init__(base_url, **default_kwargs)
+        self._base = base_url
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=_api_map.concurrency))
+        self.lock = threading.Lock()
+        self.tokens = YoutubeDataApi.burst
+        self.refilled = time.monotonic()
+        self.quota_day = None
+        self.quota_used = defaultdict(int)
+
+    def get(self, relative_url: str='', **kwargs):
+        return self.get_cached(relative_url, **kwargs)[0]
+
+    def get_cached(self, relative_url: str='', revalidate: bool=True, **kwargs):
+        """Like get, but return tuple(decoded response, True if it came from the response cache).
+        A cached response is revalidated with its ETag, and used if the API answers 304 Not Modified;
+        if `revalidate` is False, it is used without sending any request."""
+        kwargs.setdefault('timeout', 30)
+        cache_key = _response_key(relative_url, kwargs.get('params') or {}) if YoutubeDataApi.etags else None
+        cached = _cached_response(cache_key) if cache_key else None
+        if cached and not revalidate:
+            return cached['body'], True
+        with timed_stage('api', endpoint=relative_url) as event:
+            if cached:
+                kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'If-None-Match': cached['etag']})
+            response = self.send(relative_url, event, **kwargs)
+            if response.status_code == 304 and cached:
+                event['cached'] = True
+                return cached['body'], True
+            body = self.after_request(response)
+            if cache_key and response.headers.get('ETag'):
+                _cache_response(cache_key, response.headers['ETag'], body)
+            return body, False
+
+    def send(self, relative_url: str, event: dict, **kwargs):
+        """Send a GET request, retrying it as needed, and return the last response."""
+        event['quota'] = 0
+        for attempt in range(YoutubeDataApi.retries + 1):
+            self.take_token()
+            event['quota'] += self.charge(relative_url)
+            try:
+                response = self.session.get(self._base + relative_url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == YoutubeDataApi.retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                delay = self.retry_delay(response, attempt)
+                if delay is None or attempt == YoutubeDataApi.retries:
+                    return response
+            event['retries'] = attempt + 1
+            time.sleep(delay)
+
     def after_request(self, response):
         if response.status_code == 401:
             # Lost authorization, log out
@@ -29,10 +104,140 @@ class YoutubeDataApi(Url):
 
         return response.json()
 
+    def take_token(self):
+        """Wait until the rate limit lets one more request through."""
+        wait = self.try_token()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_token()
+
+    def try_token(self):
+        """Take a token and return 0 if the rate limit lets one more request through,
+        or else return the number of seconds until it does."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(YoutubeDataApi.burst, self.tokens + (now - self.refilled) * YoutubeDataApi.rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / YoutubeDataApi.rate
+
+    def charge(self, endpoint: str):
+        # Throws HTTPError
+        """Account the quota units of a request to `endpoint`, and return them.
+        Fails without sending the request if it would exceed YoutubeDataApi.quota_budget."""
+        cost = YoutubeDataApi.quota_costs.get(endpoint, 1)
+        with self.lock:
+            #The quota is reset every day at midnight Pacific Time
+            day = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 8 * 60 * 60))
+            if day != self.quota_day:
+                self.quota_day = day
+                self.quota_used.clear()
+            if YoutubeDataApi.quota_budget is not None and \
+                    sum(self.quota_used.values()) + cost > YoutubeDataApi.quota_budget:
+                raise HTTPError("the quota budget of {0} units is exhausted".format(YoutubeDataApi.quota_budget))
+            self.quota_used[endpoint] += cost
+        return cost
+
+    def quota(self):
+        """Return a dictionary of the quota units used today by endpoint."""
+        with self.lock:
+            return dict(self.quota_used)
+
+    @staticmethod
+    def backoff(attempt: int):
+        return random.uniform(0, min(YoutubeDataApi.max_delay, YoutubeDataApi.base_delay * 2 ** attempt))
+
+    def retry_delay(self, response, attempt: int):
+        """Return the number of seconds to wait before retrying the request which got `response`,
+        or None if it must not be retried."""
+        reason = None
+        if response.status_code == 403:
+            try:
+                reason = self.error_reason(response.json())
+            except ValueError:
+                pass
+        return self.delay_for(response.status_code, response.headers, reason, attempt)
+
+    @staticmethod
+    def error_reason(body):
+        """Return the reason of the error response `body` (decoded), or None."""
+        try:
+            return body['error']['errors'][0]['reason']
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def delay_for(self, status: int, headers, reason: str, attempt: int):
+        """Return the number of seconds to wait before retrying a request which got a response with `status`,
+        `headers` and error `reason` (see error_reason), or None if it must not be retried.
+        Shared by the asyncio API (see aioyoutube)."""
+        if status == 403:
+            #quotaExceeded only recovers when the daily quota is reset
+            if reason not in ('rateLimitExceeded', 'userRateLimitExceeded'):
+                return None
+        elif status != 429 and status < 500:
+            return None
+
+        delay = self.backoff(attempt)
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                try:
+                    wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    wait = 0
+            if wait > YoutubeDataApi.max_retry_after:
+                return None
+            delay = max(delay, wait)
+        return delay
+
+
+#Requests per second, and number of requests which can be sent at once after an idle period
+YoutubeDataApi.rate = 10
+YoutubeDataApi.burst = 20
+YoutubeDataApi.retries = 5
+#Seconds; the n-th retry waits a random time up to min(max_delay, base_delay * 2^n)
+YoutubeDataApi.base_delay = 1
+YoutubeDataApi.max_delay = 60
+#Requests which must wait longer than this (seconds) before a retry fail instead
+YoutubeDataApi.max_retry_after = 300
+#Quota units of each endpoint, 1 for the others
+YoutubeDataApi.quota_costs = {'search': 100}
+#Daily quota units this process may use, None for no limit
+YoutubeDataApi.quota_budget = None
+#Set to False to never send conditional requests
+YoutubeDataApi.etags = True
+#Maximum number of responses kept in the cache, the least recently used are removed
+YoutubeDataApi.max_responses = 10000
+
+
+def _api_map(func, iterable):
+    """Return list(map(func, iterable)), making up to _api_map.concurrency requests at the same time."""
+    iterable = list(iterable)
+    if len(iterable) <= 1:
+        return list(map(func, iterable))
+    with ThreadPool(min(_api_map.concurrency, len(iterable))) as pool:
+        return pool.map(func, iterable)
+
+
+_api_map.concurrency = 8
+#Maximum number of ids the Data API accepts in a single id= parameter
+_api_map.batch_size = 50
+
+
+def _batches(ids):
+    ids = list(ids)
+    return [ids[i:i + _api_map.batch_size] for i in range(0, len(ids), _api_map.batch_size)]
+
 
 _api = YoutubeDataApi('https://www.googleapis.com/youtube/v3/')
 _oauth_api = Url('https://accounts.google.com/o/oauth2/')
 _app_name = "yt-downloader-py"
+_cache_dir = os.path.join(os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache'),
+                          _app_name)
 
 
 def make_filename(filename: str):
@@ -45,13 +250,508 @@ def make_filename(filename: str):
 make_filename.invalid_chars = '/\\:*"?|<>'
 
 
-def download_audio(videoId: str, filename: str=""):
+def add_listener(callback):
+    """Call `callback(event)` for every timing event, from the thread the event happened in.
+    `event` is a dictionary with keys
+    event ('stage' for a single step, or 'track' for the whole processing of a video),
+    name (the stage: 'resolve', 'download', 'cover', 'analyze', 'convert', 'pipe', 'move', 'api';
+    'track' for tracks),
+    videoId, start (unix time), duration (seconds), ok, error,
+    and depending on the stage bytes, retries, cached, output, format, exit_code, endpoint, quota.
+    See JsonLinesExporter and PrometheusExporter"""
+    with _listeners_lock:
+        _listeners.append(callback)
+
+
+def remove_listener(callback):
+    with _listeners_lock:
+        _listeners.remove(callback)
+
+
+_listeners = []
+_listeners_lock = threading.Lock()
+_track = threading.local()
+
+
+def emit(event: dict):
+    """Send `event` to every listener. See add_listener
+    A failing listener is reported and skipped, so that instrumentation never fails the work it measures."""
+    for callback in list(_listeners):
+        try:
+            callback(event)
+        except Exception as e:
+            print("WARNING: event listener failed: " + str(e))
+
+
+@contextmanager
+def tracking(videoId: str):
+    """Attribute the events emitted by the current thread inside the block to `videoId`."""
+    previous = getattr(_track, 'videoId', None)
+    _track.videoId = videoId
+    try:
+        yield
+    finally:
+        _track.videoId = previous
+
+
+@contextmanager
+def timed_stage(name: str, event: str='stage', **fields):
+    """Emit a timing event named `name` for the block.
+    The event dictionary is yielded, so fields (e.g. bytes) can be added to it.
+    See add_listener"""
+
+    record = dict(fields, event=event, name=name, start=time.time(), ok=True, error=None)
+    record.setdefault('videoId', getattr(_track, 'videoId', None))
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['ok'] = False
+        record['error'] = str(e)
+        raise
+    finally:
+        record['duration'] = time.perf_counter() - start
+        if _listeners:
+            emit(record)
+
+
+class JsonLinesExporter:
+    """Listener writing every event as a line of JSON into the file object `file`."""
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, event: dict):
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class PrometheusExporter:
+    """Listener aggregating events into Prometheus metrics, in the text exposition format
+    returned by render(). If `path` is given, the metrics are rewritten there after every track
+    (for node_exporter's textfile collector)."""
+
+    def __init__(self, path: str=""):
+        self.path = path
+        self.lock = threading.Lock()
+        #Serializes the writers of the file, which share its tmp file
+        self.write_lock = threading.Lock()
+        self.metrics = defaultdict(float)
+
+    def __call__(self, event: dict):
+        labels = '{{stage="{0}"}}'.format(event['name']) if event['event'] == 'stage' else ''
+        with self.lock:
+            self.metrics['ytdl_{0}_seconds_sum'.format(event['event']) + labels] += event['duration']
+            self.metrics['ytdl_{0}_seconds_count'.format(event['event']) + labels] += 1
+            if not event['ok']:
+                self.metrics['ytdl_{0}_errors_total'.format(event['event']) + labels] += 1
+            for field in ('bytes', 'retries', 'quota'):
+                if event.get(field):
+                    self.metrics['ytdl_{0}_{1}_total'.format(event['event'], field) + labels] += event[field]
+        if self.path and event['event'] == 'track':
+            self.write(self.path)
+
+    def render(self):
+        with self.lock:
+            return ''.join('{0} {1}\n'.format(name, value) for name, value in sorted(self.metrics.items()))
+
+    def write(self, path: str):
+        with self.write_lock:
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.render())
+            os.replace(path + '.tmp', path)
+
+
+def _cache_db():
+    """Return the connection to the on-disk cache database, creating it on first use."""
+    with _cache_db.lock:
+        if _cache_db.connection is None:
+            os.makedirs(_cache_dir, exist_ok=True)
+            connection = sqlite3.connect(os.path.join(_cache_dir, 'cache.sqlite3'), timeout=30,
+                                         check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS streams (videoId TEXT PRIMARY KEY, info TEXT NOT NULL, '
+                               'expires REAL NOT NULL, used REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, etag TEXT NOT NULL, '
+                               'body TEXT NOT NULL, used REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS loudness (key TEXT PRIMARY KEY, measured TEXT NOT NULL, '
+                               'used REAL NOT NULL)')
+            connection.commit()
+            _cache_db.connection = connection
+        return _cache_db.connection
+
+
+#A single connection shared by all threads, serialized by the lock
+_cache_db.lock = threading.RLock()
+_cache_db.connection = None
+
+
+def _stream_expiry(url: str):
+    """Return the time at which the signed stream `url` stops being valid."""
+    params = parse_qs(urlparse(url).query)
+    try:
+        return float(params['expire'][0]) - resolve_stream.expiry_margin
+    except (KeyError, IndexError, ValueError):
+        return time.time() + resolve_stream.default_ttl
+
+
+def _stream_codec(itag, extension: str):
+    """Return the audio codec of the youtube stream with format `itag`."""
+    for codec, itags in _stream_codec.itags.items():
+        if str(itag) in itags:
+            return codec
+    return _stream_codec.extensions.get(extension)
+
+
+_stream_codec.itags = {
+    'opus': ('249', '250', '251'),
+    'vorbis': ('171', '172'),
+    'aac': ('139', '140', '141', '256', '258', '325', '328')
+}
+_stream_codec.extensions = {'webm': 'opus', 'm4a': 'aac'}
+
+
+def _cached_entry(videoId: str):
+    now = time.time()
+    with _cache_db.lock:
+        db = _cache_db()
+        row = db.execute('SELECT info, expires FROM streams WHERE videoId = ?', (videoId,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= now:
+            db.execute('DELETE FROM streams WHERE videoId = ?', (videoId,))
+            db.commit()
+            return None
+        db.execute('UPDATE streams SET used = ? WHERE videoId = ?', (now, videoId))
+        db.commit()
+    entry = json.loads(row[0])
+    if 'streams' not in entry:
+        #Entries cached by older versions only have the stream with the highest bitrate
+        entry['streams'] = [{'url': entry['url'], 'extension': entry['extension'], 'bitrate': entry['bitrate'],
+                             'codec': entry.get('codec') or _stream_codec(None, entry['extension']), 'itag': None}]
+    return entry
+
+
+def _cached_stream(videoId: str, target_format: str=None, bitrate: "bits per second"=None):
+    entry = _cached_entry(videoId)
+    return dict(entry, **select_stream(entry['streams'], target_format, bitrate)) if entry else None
+
+
+def _cache_stream(info: dict):
+    now = time.time()
+    with _cache_db.lock:
+        db = _cache_db()
+        db.execute('INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?)',
+                   (info['videoId'], json.dumps(info), info['expires'], now))
+        #TTL eviction, then LRU eviction down to max_entries
+        db.execute('DELETE FROM streams WHERE expires <= ?', (now,))
+        db.execute('DELETE FROM streams WHERE videoId NOT IN '
+                   '(SELECT videoId FROM streams ORDER BY used DESC LIMIT ?)', (resolve_stream.max_entries,))
+        db.commit()
+
+
+def _uncache_stream(videoId: str):
+    with _cache_db.lock:
+        db = _cache_db()
+        db.execute('DELETE FROM streams WHERE videoId = ?', (videoId,))
+        db.commit()
+
+
+def _response_key(endpoint: str, params: dict):
+    #Credentials don't identify the resource, but the user does for requests made on their behalf
+    identity = {name: value for name, value in params.items() if name not in ('key', 'access_token')}
+    if 'access_token' in params or params.get('mine'):
+        identity['user'] = login.username
+    return endpoint + '?' + json.dumps(identity, sort_keys=True)
+
+
+def _cached_response(key: str):
+    with _cache_db.lock:
+        db = _cache_db()
+        row = db.execute('SELECT etag, body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+        db.commit()
+    return {'etag': row[0], 'body': json.loads(row[1])}
+
+
+def _cache_response(key: str, etag: str, body: dict):
+    with _cache_db.lock:
+        db = _cache_db()
+        db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, etag, json.dumps(body), time.time()))
+        db.execute('DELETE FROM responses WHERE key NOT IN '
+                   '(SELECT key FROM responses ORDER BY used DESC LIMIT ?)', (YoutubeDataApi.max_responses,))
+        db.commit()
+
+
+def _cached_loudness(key: str):
+    with _cache_db.lock:
+        db = _cache_db()
+        row = db.execute('SELECT measured FROM loudness WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE loudness SET used = ? WHERE key = ?', (time.time(), key))
+        db.commit()
+    return json.loads(row[0])
+
+
+def _cache_loudness(key: str, measured: dict):
+    with _cache_db.lock:
+        db = _cache_db()
+        db.execute('INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)', (key, json.dumps(measured), time.time()))
+        db.execute('DELETE FROM loudness WHERE key NOT IN '
+                   '(SELECT key FROM loudness ORDER BY used DESC LIMIT ?)', (loudness.max_entries,))
+        db.commit()
+
+
+def _copyable(stream: dict, target_format: str, bitrate: "bits per second"=None):
+    return target_format is not None and (stream['extension'] == target_format or
+                                          stream['codec'] in convert.copyable.get(target_format, ())) and \
+        _within_bitrate(stream['codec'], stream['bitrate'], bitrate)
+
+
+def _acceptable(streams, bitrate):
+    """Streams with at least `bitrate`, or the one with the highest bitrate if none is good enough."""
+    return [s for s in streams if not bitrate or s['bitrate'] >= bitrate] or [max(streams, key=lambda s: s['bitrate'])]
+
+
+def _best_stream(streams, target_format, bitrate):
+    return max(streams, key=lambda s: s['bitrate'])
+
+
+def _no_transcode_stream(streams, target_format, bitrate):
+    return max([s for s in streams if _copyable(s, target_format, bitrate)] or streams, key=lambda s: s['bitrate'])
+
+
+def _smallest_stream(streams, target_format, bitrate):
+    return min(_acceptable(streams, bitrate), key=lambda s: (s['bitrate'], not _copyable(s, target_format, bitrate)))
+
+
+def _balanced_stream(streams, target_format, bitrate):
+    def cost(s):
+        #Estimated seconds spent per second of audio, downloading and then transcoding
+        return s['bitrate'] / 8 / select_stream.bandwidth + \
+            (0 if _copyable(s, target_format, bitrate) else 1 / select_stream.transcode_speed)
+    return min(_acceptable(streams, bitrate), key=lambda s: (cost(s), -s['bitrate']))
+
+
+def select_stream(streams, target_format: str=None, bitrate: "bits per second"=None, policy=None):
+    # Throws ValueError
+    """Return the stream to download among `streams` (dictionaries with keys url, extension,
+    codec, bitrate, itag) for a conversion to `target_format` at `bitrate`, according to `policy`,
+    which is either a function(streams, target_format, bitrate) or one of
+    'best': the highest bitrate
+    'no-transcode': the highest bitrate among the streams which can be remuxed into target_format
+    'smallest': the lowest bitrate of at least `bitrate`, preferring streams which can be remuxed
+    'balanced': the lowest estimated download plus transcode time, for streams of at least `bitrate`
+    (see select_stream.bandwidth and select_stream.transcode_speed)
+    Defaults to select_stream.policy"""
+
+    policy = policy or select_stream.policy
+    if not callable(policy):
+        if policy not in select_stream.policies:
+            raise ValueError("unknown stream selection policy " + str(policy))
+        policy = select_stream.policies[policy]
+    return policy(streams, target_format, bitrate)
+
+
+select_stream.policies = {
+    'best': _best_stream,
+    'no-transcode': _no_transcode_stream,
+    'smallest': _smallest_stream,
+    'balanced': _balanced_stream
+}
+select_stream.policy = 'best'
+#Download speed (bytes per second) and transcoding speed (seconds of audio per second) assumed by 'balanced'
+select_stream.bandwidth = 1 << 20
+select_stream.transcode_speed = 50
+
+
+def _video_id(videoId: str):
+    """Return the id of the video `videoId`, which may also be the URL of the video (see parseVideoId)."""
+    try:
+        return parseVideoId(videoId)
+    except ValueError:
+        return videoId
+
+
+def _resolve(videoId: str, cached: bool=True, target_format: str=None, bitrate: "bits per second"=None):
+    """Return pair(stream info as returned by resolve_stream, whether it was found in the cache)."""
+    videoId = _video_id(videoId)
+    with timed_stage('resolve', videoId=videoId) as event:
+        event['cached'] = cached
+        if cached:
+            info = _cached_stream(videoId, target_format, bitrate)
+            if info:
+                return info, True
+
+        event['cached'] = False
+        import pafy
+        video = pafy.new(videoId)
+        streams = [{
+            'url': stream.url,
+            'extension': stream.extension,
+            'codec': _stream_codec(stream.itag, stream.extension),
+            'bitrate': stream.rawbitrate,
+            'itag': str(stream.itag)
+        } for stream in video.audiostreams]
+        if not streams:
+            raise ValueError("the video has no audio streams")
+        entry = {
+            'videoId': videoId,
+            'title': video.title,
+            'author': video.author,
+            #Largest first, the largest ones don't exist for every video
+            'thumbnails': [url for url in (video.bigthumbhd, video.bigthumb, video.thumb) if url],
+            'streams': streams,
+            'expires': min(_stream_expiry(stream['url']) for stream in streams)
+        }
+        _cache_stream(entry)
+        return dict(entry, **select_stream(streams, target_format, bitrate)), False
+
+
+def resolve_stream(videoId: str, cached: bool=True, target_format: str=None, bitrate: "bits per second"=None):
+    # Throws IOError, ValueError, RuntimeError
+    """Return a dictionary describing the audio stream of the youtube video identified by `videoId`
+    to download for a conversion to `target_format` at `bitrate` (see select_stream),
+    with keys videoId, title, author, thumbnails (urls), url, extension, codec, bitrate, itag, expires,
+    and streams (every audio stream of the video).
+    Results are kept in an on-disk cache until the signed stream urls expire,
+    unless `cached` is False."""
+
+    return _resolve(videoId, cached, target_format, bitrate)[0]
+
+
+#Cached urls are discarded this many seconds before they expire, so downloads don't start on dying urls
+resolve_stream.expiry_margin = 30 * 60
+#Lifetime of cached urls which don't state their expiry time
+resolve_stream.default_ttl = 5 * 60 * 60
+resolve_stream.max_entries = 10000
+
+
+def _http():
+    """Return the requests session of the calling thread, so that downloads reuse keep-alive connections."""
+    if not hasattr(_http.local, 'session'):
+        _http.local.session = requests.Session()
+    return _http.local.session
+
+
+_http.local = threading.local()
+
+
+def _download_segment(url: str, partial: str, start: int, end: int):
+    """Return the number of retries needed."""
+    for attempt in range(_download_url.retries + 1):
+        try:
+            with _http().get(url, headers={'Range': 'bytes={0}-{1}'.format(start, end)}, stream=True,
+                             timeout=_download_url.timeout) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise IOError("server ignored the range request")
+                with open(partial, 'r+b') as f:
+                    f.seek(start)
+                    written = 0
+                    for chunk in response.iter_content(_download_url.chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+            if written != end - start + 1:
+                raise IOError("incomplete segment")
+            return attempt
+        except HTTPError as e:
+            #Client errors (e.g. a revoked url) won't go away by retrying
+            if attempt == _download_url.retries or (e.response is not None and e.response.status_code < 500
+                                                    and e.response.status_code != 429):
+                raise
+            time.sleep(2 ** attempt)
+        except (requests.ConnectionError, requests.Timeout, IOError):
+            if attempt == _download_url.retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def _download_url(url: str, filename: str, partial: str=""):
+    # Throws IOError
+    """Download `url` into `filename`, which must not exist.
+    If the server supports range requests, the file is fetched in segments of
+    _download_url.segment_size bytes over _download_url.connections parallel connections.
+    Downloaded data is kept in `partial` (and the list of completed segments in `partial`.json),
+    so that calling again with the same `partial` resumes an interrupted download.
+    The downloaded size is verified against the Content-Length reported by the server.
+    Returns the number of segment retries needed."""
+
+    head = _http().head(url, allow_redirects=True, timeout=_download_url.timeout)
+    head.raise_for_status()
+    size = int(head.headers.get('Content-Length', -1))
+    if size <= 0 or head.headers.get('Accept-Ranges') != 'bytes':
+        #No range support, download sequentially in a single connection
+        with _http().get(url, stream=True, timeout=_download_url.timeout) as response:
+            response.raise_for_status()
+            with open(filename, 'xb') as f:
+                for chunk in response.iter_content(_download_url.chunk_size):
+                    f.write(chunk)
+        return 0
+
+    if not partial:
+        partial = filename + '.part'
+    progress_file = partial + '.json'
+    done = set()
+    try:
+        with open(progress_file) as f:
+            progress = json.load(f)
+        if progress['size'] == size and progress['segment_size'] == _download_url.segment_size \
+                and os.path.getsize(partial) == size:
+            done = set(progress['done'])
+    except (OSError, ValueError, KeyError):
+        pass
+    if not done:
+        os.makedirs(os.path.dirname(partial) or '.', exist_ok=True)
+        with open(partial, 'wb') as f:
+            f.truncate(size)
+
+    lock = threading.Lock()
+    retries = [0]
+
+    def fetch(start):
+        attempts = _download_segment(url, partial, start, min(start + _download_url.segment_size, size) - 1)
+        with lock:
+            retries[0] += attempts
+            done.add(start)
+            with open(progress_file, 'w') as f:
+                json.dump({'size': size, 'segment_size': _download_url.segment_size, 'done': sorted(done)}, f)
+
+    pending = [start for start in range(0, size, _download_url.segment_size) if start not in done]
+    if pending:
+        with ThreadPool(min(_download_url.connections, len(pending))) as pool:
+            pool.map(fetch, pending)
+
+    if os.path.getsize(partial) != size or len(done) * _download_url.segment_size < size:
+        raise IOError("downloaded size doesn't match Content-Length")
+    if os.path.exists(filename):
+        raise IOError("the file already exists")
+    shutil.move(partial, filename)
+    os.remove(progress_file)
+    return retries[0]
+
+
+_download_url.timeout = 30
+_download_url.chunk_size = 1 << 16
+_download_url.segment_size = 4 << 20
+_download_url.connections = 4
+#Number of times a failed segment is retried, with exponential backoff
+_download_url.retries = 3
+
+
+def download_audio(videoId: str, filename: str="", target_format: str=None, bitrate: "bits per second"=None):
     # Throws IOError, ValueError, RuntimeError
     """Download the audio from the youtube video identified by `videoId`
     and save it in the file `filename`.
     If `filename` already exists, the function fails
     If `filename` is not specified, a tmp file is created.
-    Returns pair(video title, name of the file written)."""
+    The stream is chosen for a later conversion to `target_format` at `bitrate`, see select_stream.
+    Returns tuple(video title, name of the file written, stream extension)."""
 
     if filename == "":
         tmp = mkstemp()
@@ -61,15 +761,183 @@ def download_audio(videoId: str, filename: str=""):
     elif os.path.exists(filename):
         raise IOError("the file already exists")
 
-    video = pafy.new(videoId)
-    stream = max(video.audiostreams, key=lambda s: s.rawbitrate)
-    stream.download(filename, quiet=True)
-    return video.title, filename, stream.extension
+    videoId = _video_id(videoId)
+    info, cached = _resolve(videoId, True, target_format, bitrate)
+    if cached:
+        try:
+            return _download_stream(videoId, info, filename)
+        except HTTPError:
+            #The cached url may have been revoked before its expiry time; resolve it again
+            _uncache_stream(videoId)
+            info = resolve_stream(videoId, False, target_format, bitrate)
+
+    return _download_stream(videoId, info, filename)
+
+
+def _download_stream(videoId: str, info: dict, filename: str):
+    #Interrupted downloads of the same stream resume from this file, which one download at a time writes
+    partial = os.path.join(_cache_dir, 'partial', make_filename('{0}-{1}.part'.format(
+        videoId, info.get('itag') or info['bitrate'])))
+    _clean_partials()
+    with _locked_partial(partial), timed_stage('download', videoId=videoId) as event:
+        event['retries'] = _download_url(info['url'], filename, partial)
+        event['bytes'] = os.path.getsize(filename)
+    return info['title'], filename, info['extension']
+
+
+@contextmanager
+def _locked_partial(partial: str):
+    """Hold the lock of the partial download `partial` for the block, waiting while another thread or process
+    downloads the same stream. Locks left behind by processes which died are taken over."""
+    lock = partial + '.lock'
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if _stale_lock(lock):
+                try:
+                    os.remove(lock)
+                except OSError:
+                    pass
+                continue
+            time.sleep(_locked_partial.poll_interval)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+    finally:
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.remove(lock)
+
+
+_locked_partial.poll_interval = 0.2
+
+
+def _stale_lock(lock: str):
+    """Return True if the lock file `lock` is held by a process which no longer runs."""
+    try:
+        with open(lock) as f:
+            pid = f.read()
+        if not pid:
+            #The holder hasn't written its pid yet, unless it died right after creating the lock
+            return time.time() - os.path.getmtime(lock) > 60
+        return not _process_alive(int(pid))
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+def _process_alive(pid: int):
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        #PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        #STILL_ACTIVE
+        return code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _clean_partials():
+    """Remove the partial downloads which weren't resumed for _clean_partials.max_age seconds,
+    and the locks of dead processes. Runs once per process."""
+    with _clean_partials.lock:
+        if _clean_partials.done:
+            return
+        _clean_partials.done = True
+    directory = os.path.join(_cache_dir, 'partial')
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if name.endswith('.lock'):
+                if _stale_lock(path):
+                    os.remove(path)
+            elif not os.path.exists(path.split('.part')[0] + '.part.lock') and \
+                    time.time() - os.path.getmtime(path) > _clean_partials.max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+_clean_partials.lock = threading.Lock()
+_clean_partials.done = False
+_clean_partials.max_age = 7 * 24 * 60 * 60
+
+
+def download_cover(videoId: str, filename: str=""):
+    # Throws IOError, ValueError, RuntimeError
+    """Download the thumbnail of the youtube video identified by `videoId`, to attach as cover art,
+    and save it in the file `filename`.
+    If `filename` already exists, the function fails
+    If `filename` is not specified, a tmp file is created.
+    Returns the name of the file written."""
+
+    videoId = _video_id(videoId)
+    #Streams cached before thumbnails were resolved don't have them
+    urls = resolve_stream(videoId).get('thumbnails') or [download_cover.default_url.format(videoId)]
+    if filename == "":
+        tmp = mkstemp(suffix='.jpg')
+        os.close(tmp[0])
+        filename = tmp[1]
+    elif os.path.exists(filename):
+        raise IOError("the file already exists")
+
+    try:
+        with timed_stage('cover', videoId=videoId) as event:
+            for url in urls:
+                response = _http().get(url, timeout=_download_url.timeout)
+                #The largest thumbnails are missing for some videos
+                if response.status_code != 404:
+                    break
+            response.raise_for_status()
+            with open(filename, 'wb') as f:
+                f.write(response.content)
+            event['bytes'] = len(response.content)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    return filename
+
+
+download_cover.default_url = 'https://i.ytimg.com/vi/{0}/hqdefault.jpg'
+
+
+def _iter_pages(endpoint: str, get_params: dict):
+    """Yield every page of the paginated `endpoint` listing, following nextPageToken.
+    Once a page is unchanged since it was cached (see YoutubeDataApi.get_cached), the listing is assumed
+    unchanged and the following pages are served from the cache without any request.
+    Listings whose fields include pageInfo change on every page when videos are added or removed."""
+    response, unchanged = _api.get_cached(endpoint, params=get_params)
+    yield response
+    while 'nextPageToken' in response:
+        get_params = dict(get_params, pageToken=response['nextPageToken'])
+        response, unchanged = _api.get_cached(endpoint, params=get_params, revalidate=not unchanged)
+        yield response
 
 
-def get_playlist(playlistId: str):
-    """Return a list of videoIds containted in the youtube playlist
-    identified by `playlistId`.
+def iter_playlist(playlistId: str):
+    """Yield the videoIds contained in the youtube playlist identified by `playlistId`,
+    one page at a time, as the pages are received.
     Throws HTTPError in case of failure."""
 
     get_params = {
@@ -80,60 +948,103 @@ def get_playlist(playlistId: str):
         'key': key
     }
 
-    if login.username:
+    if current_user():
         get_params['access_token'] = login._access_token
 
-    response = _api.get("playlistItems", params=get_params)
-
-    totalResults = response['pageInfo']['totalResults']
-    playlist = []
-    while 'nextPageToken' in response:
+    for response in _iter_pages("playlistItems", get_params):
         for item in response['items']:
-            playlist.append(item['contentDetails']['videoId'])
-        get_params['pageToken'] = response['nextPageToken']
-        response = _api.get("playlistItems", params=get_params)
+            yield item['contentDetails']['videoId']
+
+
+def get_playlist(playlistId: str):
+    """Return a list of videoIds containted in the youtube playlist
+    identified by `playlistId`.
+    Throws HTTPError in case of failure."""
 
-    for item in response['items']:
-        playlist.append(item['contentDetails']['videoId'])
+    return list(iter_playlist(playlistId))
 
-    assert totalResults == len(playlist)
-    return playlist
 
+def get_playlists(playlistIds):
+    """Return a dictionary of playlistId -> list of videoIds, for every playlist in `playlistIds`.
+    The playlists are enumerated concurrently.
+    Throws HTTPError in case of failure."""
 
-def get_videos_from_channel(channelId):
-    """Return a list of videoIds publicly uploaded to a channel.
+    playlistIds = list(playlistIds)
+    return dict(zip(playlistIds, _api_map(get_playlist, playlistIds)))
+
+
+def get_video_details(videoIds, part: str='snippet,contentDetails'):
+    """Return a dictionary of videoId -> video resource (with the parts in `part`) for every available
+    video in `videoIds`, looked up 50 ids per request with requests made concurrently.
+    Throws HTTPError in case of failure."""
+
+    def lookup(batch):
+        get_params = {
+            'part': part,
+            'id': ','.join(batch),
+            'maxResults': _api_map.batch_size,
+            'key': key
+        }
+        if current_user():
+            get_params['access_token'] = login._access_token
+        return _api.get("videos", params=get_params)['items']
+
+    details = dict()
+    for items in _api_map(lookup, _batches(videoIds)):
+        for item in items:
+            details[item['id']] = item
+    return details
+
+
+def get_video_durations(videoIds):
+    """Return a dictionary of videoId -> duration (seconds) for every available video in `videoIds`,
+    looked up 50 ids per request (see get_video_details). Live streams have a duration of 0.
+    Throws HTTPError in case of failure."""
+
+    durations = dict()
+    for videoId, video in get_video_details(videoIds, 'contentDetails').items():
+        match = get_video_durations.pattern.fullmatch(video['contentDetails'].get('duration', ''))
+        if match:
+            days, hours, minutes, seconds = (int(n or 0) for n in match.groups())
+            durations[videoId] = ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+    return durations
+
+
+#ISO 8601 durations, e.g. PT1H2M3S
+get_video_durations.pattern = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+
+
+def iter_videos_from_channel(channelId):
+    """Yield the videoIds publicly uploaded to a channel, one page at a time,
+    as the pages are received.
+    The videos are listed from the uploads playlist of the channel, which costs 1 quota unit
+    per page instead of 100 for a search.
     Throws HTTPError in case of failure."""
 
     get_params = {
-        'part': 'id',
-        'channelId': channelId,
-        'fields': 'items/id,nextPageToken,pageInfo',
-        'order': 'date',
-        'maxResults': 50,
+        'part': 'contentDetails',
+        'id': channelId,
+        'fields': 'items/contentDetails/relatedPlaylists/uploads',
         'key': key
     }
-    response = _api.get("search", params=get_params)
 
-    videoIds = []
-    while 'nextPageToken' in response:
-        for item in response['items']:
-            if item['id']['kind'] == 'youtube#video':
-                videoIds.append(item['id']['videoId'])
-        get_params['pageToken'] = response['nextPageToken']
-        response = _api.get("search", params=get_params)
+    channels = _api.get("channels", params=get_params)['items']
+    if channels:
+        yield from iter_playlist(channels[0]['contentDetails']['relatedPlaylists']['uploads'])
 
-    for item in response['items']:
-        if item['id']['kind'] == 'youtube#video':
-            videoIds.append(item['id']['videoId'])
 
-    return videoIds
+def get_videos_from_channel(channelId):
+    """Return a list of videoIds publicly uploaded to a channel.
+    Throws HTTPError in case of failure."""
+
+    return list(iter_videos_from_channel(channelId))
 
 
 def get_my_playlists():
     """Return all playlists on the channel of the currently logged in user
     as a list of dictionaries with keys id, title, count, privacy.
     Throws HTTPError in case of failure."""
-    if not login.username:
+    if not current_user():
         raise AssertionError('requires authorization')
 
     get_params = {
@@ -146,11 +1057,9 @@ def get_my_playlists():
         'access_token': login._access_token
     }
 
-    response = _api.get("playlists", params=get_params)
-
-    totalResults = response['pageInfo']['totalResults']
     playlists = []
-    while 'nextPageToken' in response:
+    for response in _iter_pages("playlists", get_params):
+        totalResults = response['pageInfo']['totalResults']
         for item in response['items']:
             playlist = dict()
             playlist['id'] = item['id']
@@ -158,16 +1067,6 @@ def get_my_playlists():
             playlist['privacy'] = item['status']['privacyStatus']
             playlist['count'] = item['contentDetails']['itemCount']
             playlists.append(playlist)
-        get_params['pageToken'] = response['nextPageToken']
-        response = _api.get("playlists", params=get_params)
-
-    for item in response['items']:
-        playlist = dict()
-        playlist['id'] = item['id']
-        playlist['title'] = item['snippet']['title']
-        playlist['privacy'] = item['status']['privacyStatus']
-        playlist['count'] = item['contentDetails']['itemCount']
-        playlists.append(playlist)
 
     assert totalResults == len(playlists)
     return playlists
@@ -185,7 +1084,7 @@ def get_playlist_title(playlistId: str):
         'key': key
     }
 
-    if login.username:
+    if current_user():
         get_params['access_token'] = login._access_token
 
     response = _api.get("playlists", params=get_params)
@@ -198,14 +1097,50 @@ def get_playlist_title(playlistId: str):
         return ''
 
 
-def convert(filename: str, output: str, start_time: "seconds"=0, duration: "seconds"=-1):
-    # Throws IOError, RuntimeError
-    """Transcode the audio from file `filename` into the file `output`,
-    whose extension must specify a valid audio format.
-    The format to use for decoding `filename` is deduced from its headers
-    See convert.supported"""
+def get_playlist_titles(playlistIds):
+    """Return a dictionary of playlistId -> title for every available playlist in `playlistIds`,
+    looked up 50 ids per request with requests made concurrently.
+    Throws HTTPError in case of failure."""
+
+    def lookup(batch):
+        get_params = {
+            'part': 'snippet',
+            'id': ','.join(batch),
+            'fields': 'items/id,items/snippet/title',
+            'maxResults': _api_map.batch_size,
+            'key': key
+        }
+        if current_user():
+            get_params['access_token'] = login._access_token
+        return _api.get("playlists", params=get_params)['items']
+
+    titles = dict()
+    for items in _api_map(lookup, _batches(playlistIds)):
+        for item in items:
+            titles[item['id']] = item['snippet']['title']
+    return titles
 
-    CREATE_NO_WINDOW = 0x08000000
+
+def _ffmpeg(args: list, **kwargs):
+    """Start ffmpeg with the arguments `args`, without opening a console window on Windows."""
+    return popen(['ffmpeg', '-loglevel', 'quiet', '-n'] + args, creationflags=_ffmpeg.creationflags, **kwargs)
+
+
+#CREATE_NO_WINDOW
+_ffmpeg.creationflags = 0x08000000 if os.name == 'nt' else 0
+
+
+def _wait_ffmpeg(p, event: dict=None):
+    p.wait()
+    if event is not None:
+        event['exit_code'] = p.returncode
+    if p.returncode != 0:
+        raise RuntimeError("ffmpeg failed with code " + str(p.returncode))
+
+
+def _prepare_output(output: str):
+    # Throws IOError, RuntimeError
+    """Create the directory of `output` and return the format matching its extension."""
 
     path = max(output.rfind('\\'), output.rfind('/'))
     if path >= 0:
@@ -221,20 +1156,699 @@ def convert(filename: str, output: str, start_time: "seconds"=0, duration: "seco
 
     for fmt in convert.supported:
         if output.endswith('.' + fmt):
-            p = popen(convert._command.format(filename, fmt, output, start_time,
-                                              ('-t ' + str(duration) if duration >= 0 else '')),
-                      creationflags=CREATE_NO_WINDOW)
-            p.wait()
-            if p.returncode != 0:
-                raise RuntimeError("ffmpeg failed with code " + str(p.returncode))
-            else:
-                return
+            return fmt
 
     raise RuntimeError("unsupported format")
 
 
-convert.supported = '3gp aiff amr au flac mmf mp3 opus wav wv rm oga ogg'.split(' ')
-convert._command = 'ffmpeg -loglevel quiet -n -i "{0}" -ss {3} {4} -f {1} "{2}"'
+def _trim_args(start_time, duration):
+    return ['-ss', str(start_time)] + (['-t', str(duration)] if duration >= 0 else [])
+
+
+def _copies(fmt: str, codec: str, bitrate: "bits per second"=None, source_bitrate: "bits per second"=None):
+    """Return True if an audio stream encoded with `codec` at `source_bitrate` (None if unknown) is copied
+    as is into format `fmt` when `bitrate` is asked for: the container must hold it (see convert.copyable),
+    and a lossy stream must be no larger than `bitrate` (see _within_bitrate), or else it is transcoded."""
+    return convert.remux and codec in convert.copyable.get(fmt, ()) and _within_bitrate(codec, source_bitrate, bitrate)
+
+
+def _within_bitrate(codec: str, source_bitrate: "bits per second", bitrate: "bits per second"):
+    """Return True if a stream encoded with `codec` at `source_bitrate` (None if unknown) may be kept
+    when `bitrate` is asked for (see convert.bitrate_tolerance)."""
+    return not bitrate or codec in convert.lossless or \
+        source_bitrate is not None and source_bitrate <= bitrate * convert.bitrate_tolerance
+
+
+def _output_args(fmt: str, codec: str, output: str, bitrate: "bits per second"=None, tags: dict=None,
+                 cover: int=None, source_bitrate: "bits per second"=None):
+    """Return the ffmpeg arguments writing `output` in format `fmt` from an audio stream encoded with `codec`
+    at `source_bitrate`: the stream is copied as is if it can be (see _copies), and transcoded (at `bitrate`)
+    otherwise. See _tag_args for `tags` and `cover`."""
+    if _copies(fmt, codec, bitrate, source_bitrate):
+        codec_args = ['-c:a', 'copy']
+    else:
+        codec_args = ['-b:a', str(bitrate)] if bitrate else []
+    return _tag_args(fmt, tags, cover) + codec_args + ['-f', convert.muxers.get(fmt, fmt), output]
+
+
+def _tag_args(fmt: str, tags: dict=None, cover: int=None):
+    """Return the ffmpeg arguments selecting the first audio stream of the first input, with the metadata
+    of the dictionary `tags`, and the picture of input number `cover` (if given) attached as cover art
+    (if format `fmt` can hold it, see convert.covers)."""
+    args = ['-map', '0:a:0']
+    if cover is not None and fmt in convert.covers:
+        args += ['-map', '{0}:v:0'.format(cover), '-c:v', 'copy', '-disposition:v', 'attached_pic']
+    for name, value in sorted((tags or dict()).items()):
+        if value is not None:
+            args += ['-metadata', '{0}={1}'.format(name, value)]
+    return args
+
+
+def _cover_input(cover: str=None, start_time: "seconds"=0):
+    #The picture is shifted to the start of the output, or else trimming the output would drop it
+    return ((['-itsoffset', str(start_time)] if start_time else []) + ['-i', cover]) if cover else []
+
+
+def probe(filename: str):
+    """Return a dictionary with keys codec, sample_rate and bitrate (bits per second, of the whole file
+    if the stream doesn't tell) of the first audio stream, duration (seconds) and container
+    (the names of the format, separated by commas) of the media file `filename`,
+    with None for anything ffprobe can't tell."""
+    info = {'codec': None, 'sample_rate': None, 'bitrate': None, 'duration': None, 'container': None}
+    try:
+        p = popen(['ffprobe', '-v', 'quiet', '-select_streams', 'a:0', '-show_entries',
+                   'stream=codec_name,sample_rate,bit_rate:format=duration,format_name,bit_rate', '-of', 'json',
+                   filename],
+                  stdout=PIPE, creationflags=_ffmpeg.creationflags)
+        result = json.loads(p.communicate()[0] or b'{}')
+    except (OSError, ValueError):
+        return info
+    if result.get('streams'):
+        info['codec'] = result['streams'][0].get('codec_name')
+        try:
+            info['sample_rate'] = int(result['streams'][0]['sample_rate'])
+        except (KeyError, TypeError, ValueError):
+            pass
+    try:
+        info['duration'] = float(result['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    for entries in result.get('streams', [])[:1] + [result.get('format', dict())]:
+        try:
+            info['bitrate'] = info['bitrate'] or int(entries['bit_rate'])
+        except (KeyError, TypeError, ValueError):
+            pass
+    info['container'] = result.get('format', dict()).get('format_name')
+    return info
+
+
+def measure_loudness(filename: str):
+    # Throws RuntimeError
+    """Return the loudness of the audio from file `filename`, measured by ffmpeg's EBU R128 filter,
+    as a dictionary with keys I (integrated loudness, LUFS), thresh (its gating threshold, LUFS),
+    LRA (loudness range, LU), TP (true peak, dBFS) and sample_rate."""
+    p = popen(['ffmpeg', '-nostdin', '-nostats', '-hide_banner', '-i', filename, '-map', '0:a:0',
+               '-af', 'ebur128=peak=true:framelog=verbose', '-f', 'null', '-'],
+              stderr=PIPE, creationflags=_ffmpeg.creationflags)
+    log = p.communicate()[1].decode('utf-8', 'replace')
+    _wait_ffmpeg(p)
+    match = measure_loudness.pattern.search(log, max(0, log.rfind('Summary:')))
+    if match is None:
+        raise RuntimeError("ffmpeg didn't measure the loudness")
+    rate = re.search(r'Audio: .*?(\d+) Hz', log)
+    return dict(zip(('I', 'thresh', 'LRA', 'TP'), (float(value) for value in match.groups())),
+                sample_rate=int(rate.group(1)) if rate else None)
+
+
+measure_loudness.pattern = re.compile(r'I:\s+(\S+) LUFS\s+Threshold:\s+(\S+) LUFS\s+Loudness range:\s+'
+                                      r'LRA:\s+(\S+) LU.*?Peak:\s+(\S+) dBFS', re.DOTALL)
+
+
+def loudness(videoId: str, stream: dict, filename: str):
+    # Throws RuntimeError
+    """Return the loudness (see measure_loudness) of the audio of `videoId` from `stream`
+    (as returned by resolve_stream), downloaded into the file `filename`.
+    Measurements are kept in the on-disk cache, so a stream is only analyzed once,
+    whatever the number of formats it is later normalized into (see convert)."""
+    key = json.dumps([videoId, stream.get('itag'), stream.get('extension')])
+    with timed_stage('analyze') as event:
+        measured = _cached_loudness(key)
+        event['cached'] = measured is not None
+        if measured is None:
+            measured = measure_loudness(filename)
+            _cache_loudness(key, measured)
+    return measured
+
+
+loudness.max_entries = 100000
+
+
+def _loudness_filter(loudness: dict=None):
+    """Return the ffmpeg audio filter bringing audio of the measured `loudness` to convert.loudness_target,
+    or None if there is nothing to normalize."""
+    #ebur128 reports silence as -70 LUFS
+    if not loudness or loudness['I'] <= -70:
+        return None
+    target = convert.loudness_target
+    gain = target['I'] - loudness['I']
+    if loudness['TP'] + gain <= target['TP']:
+        #What loudnorm does in linear mode, without resampling to 192 kHz
+        return 'volume={0:.2f}dB'.format(gain)
+    #The peaks would go over the target, so loudnorm compresses them
+    return 'loudnorm=I={I}:TP={TP}:LRA={LRA}:measured_I={0[I]}:measured_TP={0[TP]}:measured_LRA={0[LRA]}:' \
+           'measured_thresh={0[thresh]}:linear=true'.format(loudness, **target) + \
+           (',aresample={0}'.format(loudness['sample_rate']) if loudness.get('sample_rate') else '')
+
+
+def _loudness_args(loudness: dict=None):
+    audio_filter = _loudness_filter(loudness)
+    return ['-af', audio_filter] if audio_filter else []
+
+
+def convert(filename: str, output: str, start_time: "seconds"=0, duration: "seconds"=-1,
+            bitrate: "bits per second"=None, tags: dict=None, cover: str=None, loudness: dict=None):
+    # Throws IOError, RuntimeError
+    """Convert the audio from file `filename` into the file `output`,
+    whose extension must specify a valid audio format.
+    The format to use for decoding `filename` is deduced from its headers.
+    If the audio codec can be stored in the output format, and its bitrate isn't above `bitrate`,
+    the audio is remuxed without transcoding (see convert.copyable), otherwise it is encoded at `bitrate`
+    (or ffmpeg's default bitrate for the format).
+    `tags` is a dictionary of metadata to write (e.g. title, artist, album, track), and `cover`
+    an image file to attach as cover art if the format can hold it (see convert.covers).
+    If `loudness` is given (see loudness), the audio is normalized to convert.loudness_target, in the same pass,
+    so it is always transcoded.
+    See convert.supported"""
+
+    fmt = _prepare_output(output)
+    with timed_stage('convert', output=output, format=fmt, normalized=bool(loudness)) as event:
+        info = probe(filename) if convert.remux and not loudness else {'codec': None, 'bitrate': None}
+        event['codec'] = info['codec']
+        event['copy'] = _copies(fmt, info['codec'], bitrate, info['bitrate'])
+        _wait_ffmpeg(_ffmpeg(['-i', filename] + _cover_input(cover, start_time) + _trim_args(start_time, duration) +
+                             _loudness_args(loudness) +
+                             _output_args(fmt, info['codec'], output, bitrate, tags, 1 if cover else None,
+                                          info['bitrate'])), event)
+
+
+convert.supported = '3gp aiff amr au flac mmf mp3 opus wav wv rm oga ogg m4a'.split(' ')
+#ffmpeg muxers of the formats whose name isn't the extension
+convert.muxers = {'m4a': 'ipod'}
+#Audio codecs which each format can hold, so they are copied instead of transcoded
+convert.copyable = {
+    'opus': ('opus',),
+    'ogg': ('opus', 'vorbis', 'flac'),
+    'oga': ('opus', 'vorbis', 'flac'),
+    'mp3': ('mp3',),
+    'flac': ('flac',),
+    'm4a': ('aac', 'alac'),
+    '3gp': ('aac', 'amr_nb'),
+    'amr': ('amr_nb',),
+    'wv': ('wavpack',)
+}
+#Lossless codecs, which are copied whatever the bitrate asked for
+convert.lossless = ('flac', 'alac', 'wavpack')
+#A lossy stream up to this factor above the bitrate asked for is still copied, as a stream's measured bitrate
+#is a little above its nominal one (a 128k AAC stream is about 130k)
+convert.bitrate_tolerance = 1.05
+#Set to False to always transcode
+convert.remux = True
+#Formats which can hold cover art
+convert.covers = ('mp3', 'm4a', 'flac')
+#Integrated loudness (LUFS), true peak (dBFS) and loudness range (LU) of normalized audio, as for loudnorm
+convert.loudness_target = {'I': -16.0, 'TP': -1.5, 'LRA': 11.0}
+
+
+def remux(filename: str, output: str, tags: dict=None, cover: str=None):
+    # Throws IOError, RuntimeError
+    """Copy the audio from file `filename` into the file `output` without transcoding,
+    so the format of `output` must be able to hold its codec, writing `tags` and `cover` as convert does."""
+
+    fmt = _prepare_output(output)
+    with timed_stage('convert', output=output, format=fmt, copy=True) as event:
+        _wait_ffmpeg(_ffmpeg(['-i', filename] + _cover_input(cover) + _tag_args(fmt, tags, 1 if cover else None) +
+                             ['-c:a', 'copy', '-f', convert.muxers.get(fmt, fmt), output]), event)
+
+
+def convert_many(filename: str, outputs: list, bitrate: "bits per second"=None, tags: dict=None,
+                 cover: str=None, loudness: dict=None):
+    # Throws IOError, RuntimeError
+    """Convert the audio from file `filename` into every file of `outputs` with a single ffmpeg process,
+    so that the audio is decoded once whatever the number of outputs.
+    Each item of `outputs` is either a filename or a tuple(filename, start_time, duration[, tags[, bitrate]]),
+    with the same meaning as the arguments of convert; the tags of an item are added to `tags`,
+    and its bitrate replaces `bitrate`.
+    Nothing is written if one of the outputs already exists or has an unsupported format."""
+
+    targets = [(output, 0, -1, None, None) if isinstance(output, str) else (tuple(output) + (None, None))[:5]
+               for output in outputs]
+    formats = [_prepare_output(target[0]) for target in targets]
+    with timed_stage('convert', output=[target[0] for target in targets], format=formats,
+                     normalized=bool(loudness)) as event:
+        info = probe(filename) if convert.remux and not loudness else {'codec': None, 'bitrate': None}
+        event['codec'] = info['codec']
+        event['copy'] = [_copies(fmt, info['codec'], target[4] or bitrate, info['bitrate'])
+                         for target, fmt in zip(targets, formats)]
+        #Each output has its own cover input, shifted to its start time
+        args = ['-i', filename] + [arg for target in targets for arg in _cover_input(cover, target[1])]
+        for i, ((output, start_time, duration, output_tags, rate), fmt) in enumerate(zip(targets, formats)):
+            args += _trim_args(start_time, duration) + _loudness_args(loudness) + \
+                    _output_args(fmt, info['codec'], output, rate or bitrate, dict(tags or {}, **(output_tags or {})),
+                                 1 + i if cover else None, info['bitrate'])
+        try:
+            _wait_ffmpeg(_ffmpeg(args), event)
+        except RuntimeError:
+            #Don't leave some of the outputs behind
+            for target in targets:
+                if os.path.exists(target[0]):
+                    os.remove(target[0])
+            raise
+
+
+def probe_chapters(filename: str):
+    """Return the chapters of the media file `filename` as a list of tuple(start time (seconds), title),
+    which is empty if it has none or ffprobe can't tell."""
+    try:
+        p = popen(['ffprobe', '-v', 'quiet', '-show_chapters', '-of', 'json', filename],
+                  stdout=PIPE, creationflags=_ffmpeg.creationflags)
+        result = json.loads(p.communicate()[0] or b'{}')
+        return [(float(chapter['start_time']), chapter.get('tags', {}).get('title', ''))
+                for chapter in result.get('chapters', [])]
+    except (OSError, ValueError, KeyError, TypeError):
+        return []
+
+
+def parse_timestamps(text: str):
+    """Return the chapters listed in `text` as a list of tuple(start time (seconds), title), sorted by start time.
+    Each line with a timestamp ([h:]m:ss) is a chapter titled by the rest of the line,
+    as in video descriptions (e.g. '0:00 Intro', '2. Title (3:25)'); other lines are ignored."""
+    chapters = []
+    for line in text.splitlines():
+        match = parse_timestamps.pattern.search(line)
+        if match:
+            hours, minutes, seconds = match.groups()
+            title = (line[:match.start()] + ' ' + line[match.end():]).strip(parse_timestamps.separators)
+            chapters.append((int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds), title))
+    return sorted(chapters, key=lambda chapter: chapter[0])
+
+
+parse_timestamps.pattern = re.compile(r'\b(?:(\d+):)?(\d{1,2}):(\d\d)\b')
+#Characters around the timestamp which aren't part of the title
+parse_timestamps.separators = ' \t-–—|:[]()'
+
+
+def parse_cue(text: str):
+    """Return the tracks of the cue sheet `text` as a list of tuple(start time (seconds), title).
+    A track starts at its INDEX 01; cue sheets referring to several files aren't supported."""
+    chapters = []
+    title = None
+    for line in text.splitlines():
+        words = line.split(None, 1)
+        command = words[0].upper() if words else None
+        if command == 'TRACK':
+            title = ''
+        elif command == 'TITLE' and title is not None and len(words) > 1:
+            title = words[1].strip().strip('"')
+        elif command == 'INDEX' and title is not None:
+            match = re.match(r'0*1\s+(\d+):(\d\d):(\d\d)', words[1] if len(words) > 1 else '')
+            if match:
+                #mm:ss:ff, with 75 frames per second
+                minutes, seconds, frames = (int(n) for n in match.groups())
+                chapters.append((minutes * 60 + seconds + frames / 75, title))
+    return chapters
+
+
+def split(filename: str, output, chapters: list, bitrate: "bits per second"=None, tags: dict=None,
+          cover: str=None, loudness: dict=None):
+    # Throws IOError, RuntimeError
+    """Convert each chapter of the audio from file `filename` into a file of its own with a single ffmpeg process
+    (see convert_many), so that the audio is read and decoded once whatever the number of chapters.
+    `chapters` is a list of tuple(start time (seconds), title), as returned by probe_chapters, parse_timestamps
+    or parse_cue; each chapter ends where the next one starts.
+    `output` is a filename, or a list of filenames, in which * is replaced by the title of each chapter
+    (chapters sharing a title are numbered, untitled ones are named after their number).
+    Each file is tagged with `tags` (see convert), its chapter title and its track number,
+    and normalized as a whole if `loudness` is given (see convert), so the chapters keep their relative levels.
+    Return the list of the files written."""
+
+    templates = [output] if isinstance(output, str) else list(output)
+    if not chapters:
+        raise RuntimeError("no chapters to split into")
+    if not all('*' in template for template in templates):
+        raise RuntimeError("the filename must contain * to split into chapters")
+
+    titles = [make_filename(title.strip()) or 'Track {0:02}'.format(i + 1) for i, (_, title) in enumerate(chapters)]
+    outputs = []
+    for i, (start, chapter) in enumerate(chapters):
+        title = titles[i] if titles.count(titles[i]) == 1 else \
+            '{0} ({1})'.format(titles[i], titles[:i].count(titles[i]) + 1)
+        duration = chapters[i + 1][0] - start if i + 1 < len(chapters) else -1
+        outputs += [(template.replace('*', title), start, duration, {'title': chapter or None, 'track': i + 1})
+                    for template in templates]
+    convert_many(filename, outputs, bitrate, tags, cover, loudness)
+    return [target[0] for target in outputs]
+
+
+def convert_parallel(filename: str, output: str, bitrate: "bits per second"=None, workers: int=None,
+                     tags: dict=None, cover: str=None, loudness: dict=None):
+    # Throws IOError, RuntimeError
+    """Convert the audio from file `filename` into the file `output` like convert, splitting long tracks
+    into up to `workers` (default convert_parallel.workers) time slices encoded by concurrent ffmpeg processes.
+    Only mp3 is sliced: without the bit reservoir its frames don't depend on each other, so slices encoded
+    from a few frames before their start are joined frame for frame, and the result only differs
+    from a single encode by the lack of bit reservoir. Each slice seeks its input shortly before its start
+    (see _seek_source), so that none decodes the whole track. Other formats, streams which would be remuxed
+    and tracks shorter than two convert_parallel.min_slice are converted by convert.
+    Normalizing (see convert) applies the same gain to every slice; tracks whose peaks must be compressed
+    are converted by convert as well.
+    See convert for `tags`, `cover` and `loudness`."""
+
+    fmt = _prepare_output(output)
+    info = probe(filename)
+    count = min(workers or convert_parallel.workers, int((info['duration'] or 0) // convert_parallel.min_slice))
+    audio_filter = _loudness_filter(loudness)
+    if fmt != 'mp3' or count < 2 or info['sample_rate'] not in _mp3_rates or \
+            (not loudness and _copies(fmt, info['codec'], bitrate, info['bitrate'])) or \
+            (audio_filter and not audio_filter.startswith('volume=')):
+        return convert(filename, output, bitrate=bitrate, tags=tags, cover=cover, loudness=loudness)
+
+    #Slice boundaries, in samples, on the grid of the mp3 frames of a single encode
+    frames = info['duration'] * info['sample_rate'] / _mp3_frame_samples
+    bounds = [round(frames * i / count) * _mp3_frame_samples for i in range(count)] + [None]
+    margin = convert_parallel.margin * _mp3_frame_samples
+    gain = ',' + audio_filter if audio_filter else ''
+    rate = info['sample_rate']
+    tmp = mkdtemp()
+    with timed_stage('convert', output=output, format=fmt, codec=info['codec'], copy=False, slices=count,
+                     normalized=bool(loudness)) as event:
+        processes = []
+        try:
+            source = _seek_source(filename, info, tmp, event)
+            slices = []
+            for i in range(count):
+                start = max(0, bounds[i] - margin)
+                #Each slice seeks its input to a whole second (so to a whole sample) a little before its start,
+                #instead of decoding everything before it; samples are then counted from that second
+                seek = max(0, start // rate - convert_parallel.seek_margin) if source else 0
+                end = ':end_sample={0}'.format(bounds[i + 1] + margin - seek * rate) if bounds[i + 1] else ''
+                path = os.path.join(tmp, '{0}.mp3'.format(i))
+                processes.append(_ffmpeg((['-ss', str(seek), '-i', source] if seek else ['-i', filename]) +
+                                         ['-af', 'asetpts=PTS-STARTPTS,atrim=start_sample={0}{1},'
+                                          'asetpts=PTS-STARTPTS{2}'.format(start - seek * rate, end, gain),
+                                          '-reservoir', '0'] + _output_args(fmt, None, path, bitrate)))
+                slices.append((path, (bounds[i] - start) // _mp3_frame_samples,
+                               (bounds[i + 1] - bounds[i]) // _mp3_frame_samples if bounds[i + 1] else None))
+            for p in processes:
+                _wait_ffmpeg(p, event)
+            joined = os.path.join(tmp, 'joined.mp3')
+            _join_mp3(slices, joined)
+            #The muxer rewrites the seek table and checksums of the Info frame
+            _wait_ffmpeg(_ffmpeg(['-i', joined] + _cover_input(cover) + _tag_args(fmt, tags, 1 if cover else None) +
+                                 ['-c:a', 'copy', '-f', fmt, output]), event)
+        except BaseException:
+            for p in processes:
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
+            if os.path.exists(output):
+                os.remove(output)
+            raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+convert_parallel.workers = os.cpu_count() or 1
+#Minimum duration (seconds) of a slice
+convert_parallel.min_slice = 60
+#Number of frames encoded before and after each slice, so that its frames are the ones of a single encode
+convert_parallel.margin = 4
+#Seconds decoded before the margin of each slice, so that the decoder has settled once the slice starts
+convert_parallel.seek_margin = 1
+#Containers (as named by ffprobe) whose timestamps count samples, so that seeking them is sample accurate
+convert_parallel.exact_containers = ('mov', 'mp4', 'm4a', 'ogg', 'flac', 'wav')
+#Codecs remuxed into Ogg to be seeked when their container's timestamps aren't exact (WebM counts milliseconds)
+convert_parallel.ogg_codecs = ('opus', 'vorbis', 'flac')
+
+
+def _seek_source(filename: str, info: dict, tmp: str, event: dict):
+    # Throws RuntimeError
+    """Return the file the slices of convert_parallel seek in, with `info` as returned by probe(filename):
+    `filename` if seeking it is sample accurate, its audio remuxed into an Ogg file in the directory `tmp`
+    if it can be, or None if it can't be seeked, in which case every slice decodes `filename` from its start.
+    Ogg keeps no end trimming, so the remuxed audio may end with the few milliseconds of padding of the encoder
+    which WebM trims."""
+    if set((info['container'] or '').split(',')).intersection(convert_parallel.exact_containers):
+        return filename
+    if info['codec'] not in convert_parallel.ogg_codecs:
+        return None
+    source = os.path.join(tmp, 'source.ogg')
+    _wait_ffmpeg(_ffmpeg(['-i', filename, '-map', '0:a:0', '-c:a', 'copy', '-f', 'ogg', source]), event)
+    return source
+
+#MPEG-1 layer III bitrates (kbps) and sample rates, indexed by the fields of the frame header
+_mp3_bitrates = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_mp3_rates = (44100, 48000, 32000)
+_mp3_frame_samples = 1152
+
+
+def _mp3_frames(data: bytes):
+    # Throws RuntimeError
+    """Split the MPEG-1 layer III file `data` into its ID3v2 tag (possibly empty) and the list of its frames."""
+    start = 10 + (data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9]) if data[:3] == b'ID3' else 0
+    tag = data[:start]
+    frames = []
+    while start < len(data):
+        header = int.from_bytes(data[start:start + 4], 'big')
+        bitrate, rate = (header >> 12) & 15, (header >> 10) & 3
+        if header >> 17 != 0x7ffd or bitrate in (0, 15) or rate == 3:
+            raise RuntimeError("unexpected mp3 frame")
+        size = 144000 * _mp3_bitrates[bitrate] // _mp3_rates[rate] + ((header >> 9) & 1)
+        frames.append(data[start:start + size])
+        start += size
+    return tag, frames
+
+
+def _mp3_info_offset(frames: list):
+    # Throws RuntimeError
+    """Return the offset of the Xing header in the first of `frames`, which must be an Info frame."""
+    #The side information of the first granule precedes it: 17 bytes in mono, 32 otherwise
+    offset = 21 if frames and frames[0][3] >> 6 == 3 else 36
+    if not frames or frames[0][offset:offset + 4] not in (b'Info', b'Xing') or \
+            int.from_bytes(frames[0][offset + 4:offset + 8], 'big') & 3 != 3:
+        raise RuntimeError("missing mp3 Info frame")
+    return offset
+
+
+def _crc16(data: bytes):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+
+def _join_mp3(slices: list, output: str):
+    # Throws IOError, RuntimeError
+    """Write into `output` the frames of the mp3 files of `slices`, a list of tuple(filename,
+    number of frames to skip, number of frames to keep or None for the rest), after the ID3 tag and Info frame
+    of the first file, updated with the number of frames joined and the end padding of the last file."""
+    frames = []
+    for filename, skip, count in slices:
+        with open(filename, 'rb') as f:
+            tag, found = _mp3_frames(f.read())
+        offset = _mp3_info_offset(found)
+        if not frames:
+            head, info = tag, bytearray(found[0])
+        frames += found[1 + skip:None if count is None else 1 + skip + count]
+
+    #Fields of the LAME tag which follows the Xing header: encoder delay and end padding (12 bits each),
+    #length of the audio, and the checksum of the first 190 bytes of the Info frame
+    lame = offset + 120
+    padding = int.from_bytes(found[0][lame + 21:lame + 24], 'big') & 0xfff
+    size = len(info) + sum(len(frame) for frame in frames)
+    info[offset + 8:offset + 16] = len(frames).to_bytes(4, 'big') + size.to_bytes(4, 'big')
+    delay = int.from_bytes(info[lame + 21:lame + 24], 'big') & 0xfff000
+    info[lame + 21:lame + 24] = (delay | padding).to_bytes(3, 'big')
+    info[lame + 28:lame + 32] = size.to_bytes(4, 'big')
+    info[lame + 34:lame + 36] = bytes(2)
+    info[lame + 34:lame + 36] = _crc16(info[:190]).to_bytes(2, 'big')
+    with open(output, 'xb') as f:
+        f.write(head)
+        f.write(info)
+        for frame in frames:
+            f.write(frame)
+
+
+def _pipe_url(url: str, output: str, args: list, event: dict):
+    """Stream `url` into the stdin of an ffmpeg process started with output arguments `args`."""
+    with _http().get(url, stream=True, timeout=_download_url.timeout) as response:
+        response.raise_for_status()
+        p = _ffmpeg(['-i', 'pipe:0'] + args, stdin=PIPE)
+        event['bytes'] = 0
+        try:
+            try:
+                for chunk in response.iter_content(_download_url.chunk_size):
+                    p.stdin.write(chunk)
+                    event['bytes'] += len(chunk)
+                p.stdin.close()
+            except BrokenPipeError:
+                #ffmpeg exited early, its return code tells why
+                pass
+            _wait_ffmpeg(p, event)
+        except BaseException:
+            p.kill()
+            p.wait()
+            if os.path.exists(output):
+                os.remove(output)
+            raise
+
+
+def convert_stream(videoId: str, output: str, start_time: "seconds"=0, duration: "seconds"=-1,
+                   bitrate: "bits per second"=None, tags: dict=None, cover: str=None):
+    # Throws IOError, ValueError, RuntimeError
+    """Download the audio from the youtube video identified by `videoId` and pipe it
+    straight into ffmpeg, which transcodes it into the file `output`, without a tmp file.
+    The stream is read sequentially over a single connection, so unlike download_audio
+    an interrupted download can't be resumed.
+    The stream and the output are chosen as for download_audio and convert.
+    Returns the video title."""
+
+    fmt = _prepare_output(output)
+    args = _cover_input(cover, start_time) + _trim_args(start_time, duration)
+    cover = 1 if cover else None
+    videoId = _video_id(videoId)
+    info, cached = _resolve(videoId, True, fmt, bitrate)
+    if cached:
+        try:
+            with timed_stage('pipe', videoId=videoId, output=output, format=fmt, codec=info['codec']) as event:
+                _pipe_url(info['url'], output, args + _output_args(fmt, info['codec'], output, bitrate, tags, cover,
+                                                                   info['bitrate']), event)
+            return info['title']
+        except HTTPError:
+            #The cached url may have been revoked before its expiry time; resolve it again
+            _uncache_stream(videoId)
+            info = resolve_stream(videoId, False, fmt, bitrate)
+
+    with timed_stage('pipe', videoId=videoId, output=output, format=fmt, codec=info['codec']) as event:
+        _pipe_url(info['url'], output, args + _output_args(fmt, info['codec'], output, bitrate, tags, cover,
+                                                           info['bitrate']), event)
+    return info['title']
+
+
+def store_key(videoId: str, stream: dict, fmt: str, bitrate: "bits per second"=None, start_time: "seconds"=0,
+              duration: "seconds"=-1, tags: dict=None, cover: bool=False, normalized: bool=False):
+    """Return the key of the store entry holding the audio of `videoId` from `stream`
+    (as returned by resolve_stream) converted to `fmt` with the arguments of convert
+    (`cover` tells whether the thumbnail of the video is attached as cover art,
+    and `normalized` whether the audio is normalized to convert.loudness_target)."""
+    params = [videoId, stream.get('itag'), stream.get('extension'), fmt, bitrate, start_time, duration]
+    if tags or cover or normalized:
+        params += [tags, bool(cover)]
+    if normalized:
+        params.append(convert.loudness_target)
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _store_path(key: str, fmt: str):
+    return os.path.join(_cache_dir, 'store', key[:2], key + '.' + fmt)
+
+
+def store_get(key: str, fmt: str):
+    """Return the path of the store entry `key` in format `fmt`, or None if it isn't stored.
+    The entry is marked as used, see store_gc."""
+    path = _store_path(key, fmt)
+    try:
+        os.utime(path)
+        return path
+    except OSError:
+        return None
+
+
+def store_add(filename: str, key: str, fmt: str):
+    """Add the file `filename` to the store as the entry `key` in format `fmt` (see store_key),
+    then collect the least recently used entries if the store holds more than store_gc.max_size bytes
+    (down to store_gc.headroom below it).
+    Return the path of the entry."""
+    path = _store_path(key, fmt)
+    added = 0
+    if not os.path.exists(path):
+        tmp = path + '.' + str(threading.get_ident())
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        materialize(filename, tmp)
+        os.replace(tmp, path)
+        added = os.path.getsize(path)
+    os.utime(path)
+    #The store is only walked once per process, and then whenever the running size goes over the limit
+    with store_gc.lock:
+        if store_gc.size is not None:
+            store_gc.size += added
+        over = store_gc.size is None or store_gc.size > store_gc.max_size
+    if over:
+        #Leave some room, so that the next entries don't each walk the store again
+        store_gc(int(store_gc.max_size * (1 - store_gc.headroom)))
+    return path
+
+
+def store_gc(max_size: "bytes"=None):
+    """Remove the least recently used entries of the store until it holds at most `max_size` bytes
+    (store_gc.max_size by default). Return the number of bytes freed.
+    The size of the store is kept in store_gc.size, see store_add."""
+    if max_size is None:
+        max_size = store_gc.max_size
+    entries = []
+    for root, dirs, files in os.walk(os.path.join(_cache_dir, 'store')):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    size = sum(entry[1] for entry in entries)
+    freed = 0
+    for mtime, entry_size, path in sorted(entries):
+        if size - freed <= max_size:
+            break
+        try:
+            os.remove(path)
+            freed += entry_size
+        except OSError:
+            pass
+    with store_gc.lock:
+        store_gc.size = size - freed
+    return freed
+
+
+store_gc.max_size = 10 << 30
+#Bytes held by the store as of the last collection plus the entries added since, None before the first one
+store_gc.size = None
+store_gc.lock = threading.Lock()
+#Fraction of max_size freed beyond the limit when store_add collects
+store_gc.headroom = 0.1
+
+
+def _reflink(filename: str, output: str):
+    import fcntl
+    with open(filename, 'rb') as src, open(output, 'xb') as dst:
+        try:
+            #FICLONE
+            fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(output)
+            raise
+
+
+def materialize(filename: str, output: str):
+    # Throws IOError
+    """Make the file `filename` (e.g. a store entry) appear at `output` without converting it again,
+    trying each method of materialize.methods in turn. Return the method used."""
+    path = max(output.rfind('\\'), output.rfind('/'))
+    if path >= 0 and not output[:path].endswith(':'):
+        os.makedirs(output[:path], exist_ok=True)
+    if os.path.lexists(output):
+        raise IOError("the file already exists")
+
+    for method in materialize.methods:
+        try:
+            if method == 'hardlink':
+                os.link(filename, output)
+            elif method == 'reflink':
+                _reflink(filename, output)
+            elif method == 'symlink':
+                os.symlink(os.path.abspath(filename), output)
+            else:
+                shutil.copyfile(filename, output)
+            return method
+        except (OSError, ImportError, AttributeError):
+            if method == materialize.methods[-1]:
+                raise
+    raise ValueError("no materialize method")
+
+
+#Symlinks spare space across filesystems but dangle once store_gc removes their entry, so they aren't used by default
+materialize.methods = ('hardlink', 'reflink', 'copy')
 
 
 def parseVideoId(url: str):
@@ -268,7 +1882,30 @@ def __gen_request_id(size):
     return ''.join(random.choice(string.ascii_lowercase + string.ascii_uppercase + string.digits) for _ in range(size))
 
 
+def _load_login():
+    """Read the name of the logged in user from the keyring, the first time only."""
+    import keyring
+    with login._lock:
+        if not login._loaded:
+            login._loaded = True
+            login.username = keyring.get_password(_app_name, "")
+
+
+def current_user():
+    """Return the name of the logged in user, or None if not logged in.
+    The stored login is loaded (and its access token refreshed) the first time it is needed,
+    so that importing this module doesn't touch the keyring nor the network."""
+    with login._lock:
+        if not login._loaded:
+            _load_login()
+            #If we have a refresh token stored, refresh the access token now
+            if login.username:
+                _refresh_token()
+    return login.username
+
+
 def _refresh_token():
+    import keyring
     if not login.username:
         return False
 
@@ -296,6 +1933,7 @@ def _refresh_token():
     with login._lock:
         login._access_token = token['access_token']
         login._access_token_refresh_timer = threading.Timer(token['expires_in'] * 0.95, _refresh_token)
+        login._access_token_refresh_timer.daemon = True
         login._access_token_refresh_timer.start()
     return True
 
@@ -304,13 +1942,15 @@ def login(privileges: "space delimited string of privileges"='youtube.readonly')
     # Send an OAuth2 request to Google's servers
     #The result is returned to the local webserver on the specified port
     #See __runserver and __serveclient
+    import keyring
+    import webbrowser
 
     #Uniquely identify this request in order to process it in __serveclient
     auth_request_id = __gen_request_id(12)
     while auth_request_id in login._token_code:
         auth_request_id = __gen_request_id(12)
 
-    redirect_uri = 'http://localhost:' + str(login.server.getsockname()[1])
+    redirect_uri = 'http://localhost:' + str(_login_server().getsockname()[1])
     response = _oauth_api.get("auth", params={
         'client_id': client_id,
         'redirect_uri': redirect_uri,
@@ -363,10 +2003,12 @@ def login(privileges: "space delimited string of privileges"='youtube.readonly')
             #The access token is used to authorize requests
             #The refresh token is used to get new access tokens as they expire
             login.username = response['items'][0]['snippet']['title']
+            login._loaded = True
             keyring.set_password(_app_name, login.username, token['refresh_token'])
             keyring.set_password(_app_name, "", login.username)
             login._access_token = token['access_token']
             login._access_token_refresh_timer = threading.Timer(token['expires_in'] * 0.95, _refresh_token)
+            login._access_token_refresh_timer.daemon = True
             login._access_token_refresh_timer.start()
     except HTTPError:
         return False
@@ -375,7 +2017,10 @@ def login(privileges: "space delimited string of privileges"='youtube.readonly')
 
 
 def logout():
+    import keyring
     with login._lock:
+        #The user to log out may not have been loaded yet
+        _load_login()
         try:
             if login.username:
                 keyring.delete_password(_app_name, login.username)
@@ -482,20 +2127,29 @@ def __serveclient(sock):
 
 
 # Run a local web server to handle oauth responses
-def __runserver():
-    login.server = socket.socket()
-    login.server.bind(('0.0.0.0', 0))
-    login.server.listen(5)
+def __runserver(server):
     try:
-        client = login.server.accept()
+        client = server.accept()
         while client:
             threading.Thread(target=__serveclient, args=(client[0],)).start()
-            client = login.server.accept()
+            client = server.accept()
     except OSError:
         pass
 
 
-threading.Thread(target=__runserver).start()
+def _login_server():
+    """Return the socket of the local webserver receiving OAuth responses, starting it on first use."""
+    with login._lock:
+        if login.server is None:
+            login.server = socket.socket()
+            login.server.bind(('0.0.0.0', 0))
+            login.server.listen(5)
+            threading.Thread(target=__runserver, args=(login.server,), daemon=True).start()
+    return login.server
+
+
+#Local webserver receiving OAuth responses, see _login_server
+login.server = None
 
 #A dictionary of access token codes received as responses from oauth requests
 #keys are random strings used to identify access token requests
@@ -509,11 +2163,9 @@ login._access_token = ""
 #Timer used to refresh access token
 login._access_token_refresh_timer = None
 login._lock = threading.RLock()
-login.username = keyring.get_password(_app_name, "")
-
-#If we have a refresh token stored, refresh the access token now
-if login.username:
-    _refresh_token()
+#Name of the logged in user, see current_user
+login.username = None
+login._loaded = False
 
 
 # noinspection PyBroadException
@@ -525,7 +2177,8 @@ def __end__():
     except:
         pass
     try:
-        login.server.close()
+        if login.server:
+            login.server.close()
     except:
         pass
     return
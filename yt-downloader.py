@@ -1,14 +1,30 @@
 import youtube
-from multiprocessing.pool import ThreadPool
 from os import remove
 import functools
 import shutil
 import os.path
-from threading import Lock
+import json
+import csv
+import hashlib
+import re
+import time
+import itertools
+import hmac
+import secrets
+from urllib.parse import urlparse
+from threading import Lock, Thread, Event, Condition
+from queue import Queue, PriorityQueue, Empty, Full
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.request
+import urllib.error
 import sys
 import argparse
 
-pool = ThreadPool()
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 
 def menu(prompt: str, options: "list of pairs(string, function); "
@@ -46,28 +62,180 @@ def menu(prompt: str, options: "list of pairs(string, function); "
     return True
 
 
-def work_on_song(videoId: str, filename: str, target_format):
-    song = None
+def report_track(videoId: str, started: float, output: str=None, error: str=None):
+    """Emit the timing event of the whole processing of `videoId`, started at time `started`."""
+    youtube.emit({'event': 'track', 'name': 'track', 'videoId': videoId, 'start': started,
+                  'duration': time.time() - started, 'ok': error is None, 'error': error, 'output': output})
+
+
+def fetch_song(videoId: str, target_format=None, bitrate: "bits per second"=None):
+    """Download stage of the playlist pipeline: download the audio of `videoId` into a tmp file,
+    choosing the stream for a conversion to `target_format` at `bitrate`.
+    Return tuple(videoId, tuple returned by youtube.download_audio, start time),
+    or None in case of failure."""
+    started = time.time()
     try:
-        song = youtube.download_audio(videoId)
-        target_filename = filename.replace('*', youtube.make_filename(song[0]))
-        if song[2] == target_format:
-            shutil.move(song[1], target_filename)
-        else:
-            youtube.convert(song[1], target_filename)
-        if not os.path.isfile(target_filename):
+        with youtube.tracking(videoId):
+            return videoId, youtube.download_audio(videoId, target_format=target_format, bitrate=bitrate), started
+    except (IOError, RuntimeError, ValueError, OSError) as e:
+        with work_on_song.lock:
+            print("WARNING: failed to download " + videoId + ": " + str(e))
+        report_track(videoId, started, error=str(e))
+        return None
+
+
+def song_tags(info: dict, tags: dict=None):
+    """Return the tags to write into the files of the video described by `info` (as returned by
+    youtube.resolve_stream): its title and author, with `tags` (e.g. album, track) added.
+    Return None if song_tags.enabled is False."""
+    if not song_tags.enabled:
+        return None
+    return dict({'title': info['title'], 'artist': info.get('author')}, **(tags or {}))
+
+
+song_tags.enabled = False
+
+
+def song_cover(videoId: str):
+    """Download the thumbnail of `videoId` into a tmp file, and return its name, to attach as cover art.
+    Return None if song_cover.enabled is False, or if the thumbnail can't be downloaded."""
+    if not song_cover.enabled:
+        return None
+    try:
+        return youtube.download_cover(videoId)
+    except (IOError, RuntimeError, ValueError, OSError) as e:
+        with work_on_song.lock:
+            print("WARNING: no cover art for " + videoId + ": " + str(e))
+        return None
+
+
+song_cover.enabled = False
+
+
+def song_loudness(videoId: str, filename: str, target_format, bitrate: "bits per second"=None):
+    # Throws IOError, RuntimeError, ValueError
+    """Return the loudness of the audio of `videoId`, downloaded into `filename` by download_audio
+    for `target_format` at `bitrate`, to normalize it (see youtube.loudness).
+    Return None if song_loudness.enabled is False."""
+    if not song_loudness.enabled:
+        return None
+    return youtube.loudness(videoId, youtube.resolve_stream(videoId, target_format=target_format, bitrate=bitrate),
+                            filename)
+
+
+song_loudness.enabled = False
+
+
+def finish_song(fetched, filename, target_format, bitrate: "bits per second"=None, keys: list=None,
+                tags: dict=None):
+    """Transcode stage of the playlist pipeline: move or convert the tmp file of `fetched`
+    (as returned by fetch_song) into `filename`, then remove the tmp file.
+    `filename` may be a list of filenames, which are then all written by a single ffmpeg process.
+    `bitrate` may also be a list of the bitrates of each filename.
+    The files are tagged and given cover art as set by song_tags and song_cover, `tags` being added to the tags,
+    and normalized as set by song_loudness.
+    If `keys` is given (see store_keys), the files written are also added to the store.
+    Return the list of the files written, or None in case of failure."""
+    videoId, song, started = fetched
+    filenames = [filename] if isinstance(filename, str) else list(filename)
+    bitrates = list(bitrate) if isinstance(bitrate, list) else [bitrate] * len(filenames)
+    #The stream was chosen for the highest bitrate (see stream_bitrate)
+    bitrate = stream_bitrate(bitrates)
+    targets = None
+    cover = None
+    try:
+        with youtube.tracking(videoId):
+            targets = [name.replace('*', youtube.make_filename(song[0])) for name in filenames]
+            metadata = song_tags(youtube.resolve_stream(videoId), tags) if song_tags.enabled else None
+            cover = song_cover(videoId)
+            loudness = song_loudness(videoId, song[1], target_format, bitrate)
+            #With a bitrate asked for, convert decides whether the stream is small enough to be copied,
+            #unless ffmpeg can't write the format
+            keep = song[2] == target_format and not loudness and \
+                (not bitrates[0] or target_format not in youtube.convert.supported)
+            if len(targets) > 1:
+                youtube.convert_many(song[1], [(target, 0, -1, None, rate) for target, rate in zip(targets, bitrates)],
+                                     None, metadata, cover, loudness)
+            elif keep and (metadata or cover):
+                #Tags are written while copying the stream, so the file is still written once
+                youtube.remux(song[1], targets[0], metadata, cover)
+            elif keep:
+                with youtube.timed_stage('move', output=targets[0]):
+                    shutil.move(song[1], targets[0])
+            else:
+                youtube.convert(song[1], targets[0], bitrate=bitrates[0], tags=metadata, cover=cover,
+                                loudness=loudness)
+        if not all(os.path.isfile(target) for target in targets):
             raise IOError('failed to write target file')
+        if keys:
+            with youtube.tracking(videoId), youtube.timed_stage('store'):
+                for target, key in zip(targets, keys):
+                    youtube.store_add(target, key, output_format(target))
         with work_on_song.lock:
-            print(target_filename)
+            for target in targets:
+                print(target)
             work_on_song.success_count += 1
+        report_track(videoId, started, ', '.join(targets))
+        return targets
     except (IOError, RuntimeError, ValueError, OSError, shutil.Error) as e:
-        print("WARNING: failed to download " + song[0] + ": " + str(e))
+        with work_on_song.lock:
+            print("WARNING: failed to download " + song[0] + ": " + str(e))
+        report_track(videoId, started, targets and ', '.join(targets), str(e))
     finally:
-        if song:
+        for name in (song[1], cover):
             try:
-                remove(song[1])
+                if name:
+                    remove(name)
             except (OSError, IOError):
                 pass
+    return None
+
+
+def stream_bitrate(bitrates: list):
+    """Return the bitrate to choose the stream for, to convert it at each of `bitrates`:
+    the highest one, or None if there are only default bitrates."""
+    return max(bitrates, key=lambda rate: rate or 0) if bitrates else None
+
+
+def pipe_song(videoId: str, filename: str, target_format, bitrate: "bits per second"=None, tags: dict=None):
+    """Download the audio of `videoId` straight into ffmpeg, which writes `filename`, without a tmp file.
+    Return the list of the files written (like finish_song), or None in case of failure."""
+    started = time.time()
+    title = videoId
+    target_filename = None
+    cover = None
+    try:
+        with youtube.tracking(videoId):
+            info = youtube.resolve_stream(videoId, target_format=target_format, bitrate=bitrate)
+            title = info['title']
+            target_filename = filename.replace('*', youtube.make_filename(title))
+            cover = song_cover(videoId)
+            youtube.convert_stream(videoId, target_filename, bitrate=bitrate, tags=song_tags(info, tags),
+                                   cover=cover)
+        if not os.path.isfile(target_filename):
+            raise IOError('failed to write target file')
+        with work_on_song.lock:
+            print(target_filename)
+            work_on_song.success_count += 1
+        report_track(videoId, started, target_filename)
+        return [target_filename]
+    except (IOError, RuntimeError, ValueError, OSError) as e:
+        with work_on_song.lock:
+            print("WARNING: failed to download " + title + ": " + str(e))
+        report_track(videoId, started, target_filename, str(e))
+    finally:
+        try:
+            if cover:
+                remove(cover)
+        except (OSError, IOError):
+            pass
+    return None
+
+
+def work_on_song(videoId: str, filename: str, target_format, bitrate: "bits per second"=None):
+    fetched = fetch_song(videoId, target_format, bitrate)
+    if fetched:
+        finish_song(fetched, filename, target_format, bitrate)
     return
 
 
@@ -75,20 +243,497 @@ work_on_song.lock = Lock()
 work_on_song.success_count = 0
 
 
-def dl_video(videoId: str=None, filename: str=None):
+def store_keys(videoId: str, target_formats: list, bitrate: "bits per second"=None, tags: dict=None):
+    """Return the video title and the keys of the store entries of `videoId` converted to each of `target_formats`,
+    for the stream download_audio would choose (the stream is resolved from the cache if possible),
+    and for the tags, cover art and normalization finish_song would write (with `tags` added)."""
+    info = youtube.resolve_stream(videoId, target_format=target_formats[0], bitrate=bitrate)
+    return info['title'], [youtube.store_key(videoId, info, fmt, bitrate, tags=song_tags(info, tags),
+                                             cover=song_cover.enabled, normalized=song_loudness.enabled)
+                           for fmt in target_formats]
+
+
+def take_from_store(videoId: str, title: str, keys: list, filenames: list, started: float):
+    """Materialise the store entries `keys` of `videoId` into `filenames`, without downloading or converting anything.
+    Return the list of the files written, or None if one of the entries isn't stored."""
+    paths = [youtube.store_get(key, output_format(name)) for key, name in zip(keys, filenames)]
+    if not all(paths):
+        return None
+    targets = [name.replace('*', youtube.make_filename(title)) for name in filenames]
+    with youtube.tracking(videoId), youtube.timed_stage('materialize', output=targets):
+        for path, target in zip(paths, targets):
+            youtube.materialize(path, target)
+    with work_on_song.lock:
+        for target in targets:
+            print(target)
+        work_on_song.success_count += 1
+    report_track(videoId, started, ', '.join(targets))
+    return targets
+
+
+def claim_song(keys: list):
+    """Return True if the caller is the one worker to produce the store entries `keys`,
+    which it must then release with release_song. Otherwise, wait until the worker producing them
+    has released them, and return False."""
+    with claim_song.lock:
+        done = claim_song.pending.get(tuple(keys))
+        if done is None:
+            claim_song.pending[tuple(keys)] = Event()
+            return True
+    done.wait()
+    return False
+
+
+def release_song(keys: list):
+    with claim_song.lock:
+        claim_song.pending.pop(tuple(keys)).set()
+
+
+claim_song.lock = Lock()
+claim_song.pending = dict()
+
+
+class Limiter:
+    """Semaphore whose number of permits can be changed while threads hold it."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.condition = Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def resize(self, limit: int):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class AdaptiveConcurrency:
+    """Controller of the number of active workers of each stage of run_pipeline, adjusted every `interval` seconds.
+    Downloads: additive increase while the downloaded bytes per second keep up, one step back when an increase
+    made them drop, and multiplicative decrease when YouTube throttles (403/429 responses or retried segments).
+    Transcodes: one more while songs wait in the queue and the CPUs aren't saturated, one less once they are.
+    The number of workers of each stage stays within its (floor, ceiling) range."""
+
+    def __init__(self, download_workers: int, transcode_workers: int, download_range: tuple=None,
+                 transcode_range: tuple=None, interval: "seconds"=None):
+        self.download_range = download_range or AdaptiveConcurrency.download_range
+        self.transcode_range = transcode_range or AdaptiveConcurrency.transcode_range
+        self.interval = interval or AdaptiveConcurrency.interval
+        self.downloads = Limiter(min(max(download_workers, self.download_range[0]), self.download_range[1]))
+        self.transcodes = Limiter(min(max(transcode_workers, self.transcode_range[0]), self.transcode_range[1]))
+        self.lock = Lock()
+        self.bytes = 0
+        self.throttled = 0
+        self.throughput = 0.0
+        self.increased = False
+        self.stopped = Event()
+
+    def __call__(self, event: dict):
+        """Listener of the download events, see youtube.add_listener."""
+        if event['event'] != 'stage' or event['name'] not in ('download', 'pipe'):
+            return
+        with self.lock:
+            self.bytes += event.get('bytes') or 0
+            if event.get('retries') or re.search(r'\b(403|429)\b', event.get('error') or ''):
+                self.throttled += 1
+
+    def run(self, queue: Queue):
+        """Adjust the limits until stop() is called. `queue` holds the songs waiting to be transcoded."""
+        last, cpu = time.perf_counter(), self.cpu_time()
+        while not self.stopped.wait(self.interval):
+            now, now_cpu = time.perf_counter(), self.cpu_time()
+            with self.lock:
+                throughput, throttled = self.bytes / (now - last), self.throttled
+                self.bytes = self.throttled = 0
+            self.adjust(throughput, throttled, (now_cpu - cpu) / (now - last) / (os.cpu_count() or 1),
+                        queue.qsize(), queue.maxsize)
+            last, cpu = now, now_cpu
+
+    def adjust(self, throughput: "bytes per second", throttled: int, cpu_load: float, queued: int, queue_size: int):
+        previous = downloads = self.downloads.limit
+        if throttled:
+            downloads //= 2
+        elif throughput:
+            #Bytes are counted when a download ends, so intervals in which none ended are skipped
+            if self.increased and throughput < self.throughput * AdaptiveConcurrency.tolerance:
+                downloads -= 1
+            elif queued < queue_size:
+                #When the queue is full, downloaders wait for transcoders and more of them wouldn't help
+                downloads += 1
+            self.throughput = throughput
+        downloads = min(max(downloads, self.download_range[0]), self.download_range[1])
+        if throttled or throughput:
+            #Only an increase is undone when the throughput drops
+            self.increased = downloads > previous
+        self.downloads.resize(downloads)
+
+        transcodes = self.transcodes.limit
+        if cpu_load > AdaptiveConcurrency.cpu_high:
+            transcodes -= 1
+        elif queued and cpu_load < AdaptiveConcurrency.cpu_low:
+            transcodes += 1
+        self.transcodes.resize(min(max(transcodes, self.transcode_range[0]), self.transcode_range[1]))
+
+    @staticmethod
+    def cpu_time():
+        """Return the CPU seconds spent so far by every process of the system, so that running ffmpeg
+        processes are counted. It comes from psutil if it is installed, otherwise from /proc/stat.
+        Without either, only this process and the ffmpeg processes already waited for are counted,
+        which misses the load of the transcodes still running."""
+        if psutil is not None:
+            times = psutil.cpu_times()
+            #Guest time is already counted in user time
+            return sum(times) - times.idle - sum(getattr(times, name, 0)
+                                                 for name in ('iowait', 'guest', 'guest_nice'))
+        try:
+            with open('/proc/stat') as f:
+                #cpu user nice system idle iowait irq softirq steal guest guest_nice, in clock ticks
+                ticks = [int(value) for value in f.readline().split()[1:9]]
+            return (sum(ticks) - ticks[3] - ticks[4]) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError, AttributeError):
+            times = os.times()
+            return times.user + times.system + times.children_user + times.children_system
+
+    def stop(self):
+        self.stopped.set()
+
+
+AdaptiveConcurrency.download_range = (1, 8 * (os.cpu_count() or 1))
+AdaptiveConcurrency.transcode_range = (1, 2 * (os.cpu_count() or 1))
+AdaptiveConcurrency.interval = 5.0
+#Fraction of the previous throughput under which the last increase is undone
+AdaptiveConcurrency.tolerance = 0.9
+#CPU load (1.0 = every core busy) over which transcodes decrease, and under which they may increase
+AdaptiveConcurrency.cpu_high = 0.95
+AdaptiveConcurrency.cpu_low = 0.8
+
+
+def run_pipeline(items, download, transcode, download_workers: int, transcode_workers: int, queue_size: int,
+                 controller: AdaptiveConcurrency=None, rank=None):
+    """Run `download` on every element of `items` in `download_workers` threads, and `transcode`
+    on every non-None result in `transcode_workers` threads, so that network-bound and
+    CPU-bound work don't compete for the same workers.
+    At most `queue_size` downloaded results wait between the stages; when the queue is full
+    the downloaders block until a transcoder catches up, so at most
+    download_workers + queue_size + transcode_workers tmp files exist at any time.
+    If `controller` is given, it adjusts the number of active workers of each stage while the pipeline runs,
+    and the worker counts are only its starting points.
+    Workers take the next item whenever they are free, so none stays idle while items remain.
+    If `rank` is given (a function of an item), the waiting result whose item has the lowest rank is transcoded
+    first instead of the first downloaded; with `items` sorted by rank as well (e.g. longest song first),
+    the longest work starts first and the last songs don't run on their own at the end.
+    An exception raised by `download`, `transcode` or `items` is raised once the pipeline drains
+    (the first one if there are several); the other items are still processed, unless `items` raised."""
+
+    items = iter(items)
+    items_lock = Lock()
+    downloaded = PriorityQueue(maxsize=max(1, queue_size)) if rank else Queue(maxsize=max(1, queue_size))
+    #Results of the same rank are transcoded in download order, and after every result once the pipeline drains
+    order = itertools.count()
+    done = object()
+    errors = []
+    if controller:
+        downloads, transcodes = controller.downloads, controller.transcodes
+        download_workers, transcode_workers = controller.download_range[1], controller.transcode_range[1]
+    else:
+        downloads, transcodes = Limiter(max(1, download_workers)), Limiter(max(1, transcode_workers))
+
+    def download_stage():
+        while True:
+            with downloads:
+                with items_lock:
+                    try:
+                        item = next(items, done)
+                    except Exception as e:
+                        #Stop every downloader; the error is raised once the pipeline drains
+                        errors.append(e)
+                        item = done
+                if item is done:
+                    return
+                try:
+                    result = download(item)
+                    if result is not None:
+                        downloaded.put((False, rank(item), next(order), result) if rank else result)
+                except Exception as e:
+                    #The worker goes on with the other items; the error is raised once the pipeline drains
+                    errors.append(e)
+
+    def transcode_stage():
+        while True:
+            with transcodes:
+                result = downloaded.get()
+                if rank:
+                    result = result[3]
+                if result is done:
+                    return
+                try:
+                    transcode(result)
+                except Exception as e:
+                    errors.append(e)
+
+    downloaders = [Thread(target=download_stage, daemon=True) for _ in range(max(1, download_workers))]
+    transcoders = [Thread(target=transcode_stage, daemon=True) for _ in range(max(1, transcode_workers))]
+    if controller:
+        youtube.add_listener(controller)
+        Thread(target=controller.run, args=(downloaded,), daemon=True).start()
+    try:
+        for thread in downloaders + transcoders:
+            thread.start()
+        for thread in downloaders:
+            thread.join()
+        for _ in transcoders:
+            downloaded.put((True, None, next(order), done) if rank else done)
+        for thread in transcoders:
+            thread.join()
+    finally:
+        if controller:
+            controller.stop()
+            youtube.remove_listener(controller)
+    if errors:
+        raise errors[0]
+
+
+def prefetch(iterable, size: int, rank=None, stop: Event=None):
+    """Yield the elements of `iterable`, which is consumed by a background thread up to
+    `size` elements ahead of the caller, so that a slow producer (e.g. a paginated listing)
+    runs concurrently with the work done on its elements. The thread starts at once, before the first element
+    is asked for. It stops once `stop` is set, which the generator returned does when it is closed before
+    the end (e.g. when the caller leaves a for loop early); a caller that may not iterate it at all must set
+    `stop` itself, so that the thread doesn't wait forever for room in the buffer.
+    If `rank` is given (a function of an element), the element yielded is the one of lowest rank
+    among the (up to `size`) elements received and not yet yielded, instead of the first of them.
+    Exceptions raised by `iterable` are raised in the caller."""
+
+    buffer = Queue(maxsize=max(1, size))
+    stop = stop or Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=prefetch.poll_interval)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((False, item)):
+                    return
+            put((True, None))
+        except Exception as e:
+            put((True, e))
+
+    def get(block: bool=True):
+        #Once `stop` is set, the elements left are dropped
+        while not stop.is_set():
+            try:
+                return buffer.get(block, prefetch.poll_interval)
+            except Empty:
+                if not block:
+                    raise
+        return True, None
+
+    def consume():
+        try:
+            if rank is None:
+                end, item = get()
+                while not end:
+                    yield item
+                    end, item = get()
+                if item is not None:
+                    raise item
+                return
+
+            heap = []
+            order = itertools.count()
+            end, error = False, None
+            while True:
+                #Take the elements already received, only waiting when there is none to yield
+                while not end and len(heap) < size:
+                    try:
+                        end, item = get(block=not heap)
+                    except Empty:
+                        break
+                    if end:
+                        error = item
+                    else:
+                        heapq.heappush(heap, (rank(item), next(order), item))
+                if not heap:
+                    break
+                yield heapq.heappop(heap)[2]
+            if error is not None:
+                raise error
+        except GeneratorExit:
+            #The caller stopped early
+            stop.set()
+            raise
+
+    Thread(target=produce, daemon=True).start()
+    return consume()
+
+
+#Seconds between checks of `stop` while waiting for room in the buffer or for the next element
+prefetch.poll_interval = 0.5
+
+
+def with_durations(items, durations: dict, select):
+    """Yield the videoIds `select` returns for the elements of `items` (None skips an element), looking up
+    the durations of each batch of elements selected into `durations` (see song_durations) before yielding it,
+    so that the lookups follow a paginated listing page by page and only cover the songs selected."""
+    items = iter(items)
+    batch = list(itertools.islice(items, youtube._api_map.batch_size))
+    while batch:
+        videoIds = [videoId for videoId in map(select, batch) if videoId is not None]
+        if videoIds:
+            durations.update(song_durations(videoIds))
+        yield from videoIds
+        batch = list(itertools.islice(items, youtube._api_map.batch_size))
+
+
+def song_durations(videoIds: list):
+    """Return a dictionary of videoId -> duration (seconds) of `videoIds` (see youtube.get_video_durations).
+    It is empty if the durations can't be looked up, and the songs are then processed in their order."""
+    try:
+        return youtube.get_video_durations(videoIds)
+    except IOError as e:
+        print("WARNING: the durations of the songs are unavailable: " + str(e))
+        return dict()
+
+
+def output_format(filename: str):
+    """Return the supported format matching the extension of `filename`, or '' if there is none."""
+    for fmt in youtube.convert.supported:
+        if filename.endswith('.' + fmt):
+            return fmt
+    return ''
+
+
+def manifest_path(filename: str):
+    """Return the path of the sync manifest of the directory `filename` (a target filename template) expands into."""
+    directory = os.path.dirname(filename.split('*')[0])
+    return os.path.join(directory or '.', manifest_path.name)
+
+
+manifest_path.name = '.yt-downloader.json'
+
+
+def manifest_key(videoId: str, filename: str):
+    """Return the key of the manifest entry of `videoId` for the target filename template `filename`.
+    Several targets may share the directory, and so the manifest, of `filename`."""
+    directory = os.path.dirname(filename.split('*')[0])
+    return videoId + ':' + filename[len(directory):].lstrip('/\\')
+
+
+def manifest_lookup(manifest: dict, videoId: str, filename: str):
+    """Return the entry of `videoId` for the target `filename` in `manifest`, or None.
+    Manifests written before entries were keyed by target have entries keyed by videoId alone."""
+    return manifest.get(manifest_key(videoId, filename)) or manifest.get(videoId)
+
+
+def load_manifest(path: str):
+    """Return the sync manifest stored in `path`, a dictionary of
+    manifest_key -> dictionary with keys path, size, hash, format.
+    Return an empty manifest if `path` doesn't exist."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+    except ValueError:
+        print("WARNING: ignoring corrupt manifest " + path)
+        return dict()
+
+
+def save_manifest(path: str, manifest: dict):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def manifest_entry(filename: str, target_format):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(chunk)
+    return {'path': filename, 'size': os.path.getsize(filename), 'hash': sha1.hexdigest(), 'format': target_format}
+
+
+def is_synced(entry: dict, target_format):
+    """Return True if the file recorded by the manifest `entry` is still present and up to date.
+    Only the size is checked, so that syncing an unchanged playlist doesn't read every file."""
+    try:
+        return entry['format'] == target_format and os.path.getsize(entry['path']) == entry['size']
+    except (OSError, KeyError):
+        return False
+
+
+def dl_video(videoId: str=None, filename=None, pipe: bool=False, bitrate: "bits per second"=None):
+    """Download the audio of a video.
+    `filename` may be a list of filenames, which are then all written by a single ffmpeg process.
+    If `pipe` is True and a single `filename` is given, the download is piped into ffmpeg without a tmp file
+    (unless song_loudness is enabled, as the whole file is analyzed before being normalized).
+    If `bitrate` is given, it is the bitrate to transcode at.
+    If dl_video.parallel is True, a single `filename` is converted in time slices (see youtube.convert_parallel).
+    If dl_video.split is set, the audio is split into one file per chapter (see video_chapters),
+    and * in `filename` expands to the chapter title instead of the video title.
+    The files are tagged and given cover art as set by song_tags and song_cover, and normalized as set by
+    song_loudness."""
     vidParam = not not videoId
     fnameParam = not not filename
+    if isinstance(filename, list) and len(filename) == 1:
+        filename = filename[0]
     while True:
         if not videoId:
             videoId = input("Video URL | [Enter] - Cancel\n")
             if not videoId:
                 return False
 
+        if pipe and isinstance(filename, str) and not dl_video.split and not song_loudness.enabled:
+            cover = None
+            try:
+                print("Downloading...")
+                info = youtube.resolve_stream(videoId, target_format=output_format(filename), bitrate=bitrate)
+                print("Video title: " + info['title'])
+                cover = song_cover(videoId)
+                youtube.convert_stream(videoId, filename.replace('*', youtube.make_filename(info['title'])),
+                                       bitrate=bitrate, tags=song_tags(info), cover=cover)
+                print("Done")
+                return True
+            except ValueError:
+                print("Invalid video ID or URL")
+                return False
+            except (IOError, RuntimeError) as e:
+                print(e)
+                return False
+            finally:
+                if cover:
+                    remove(cover)
+
         song = None
+        cover = None
         try:
             print("Downloading...")
-            song = youtube.download_audio(videoId)
+            #With several targets, the stream is chosen for the first one
+            stream_format = output_format(filename if isinstance(filename, str) else filename[0]) if filename else None
+            song = youtube.download_audio(videoId, target_format=stream_format, bitrate=bitrate)
             print("Video title: " + song[0])
+            metadata = song_tags(youtube.resolve_stream(videoId)) if song_tags.enabled else None
+            cover = song_cover(videoId)
+            loudness = song_loudness(videoId, song[1], stream_format, bitrate)
 
             if not filename:
                 print("Supported formats: " + str(youtube.convert.supported))
@@ -100,10 +745,23 @@ def dl_video(videoId: str=None, filename: str=None):
                     if not filename:
                         return False
 
-                filename = filename.replace('*', youtube.make_filename(song[0]))
                 try:
                     print("Converting...")
-                    youtube.convert(song[1], filename)
+                    if dl_video.split:
+                        #Chapters are tracks of an album named after the video
+                        filename = youtube.split(song[1], filename, video_chapters(videoId, song[1], dl_video.split),
+                                                 bitrate, metadata and dict(metadata, album=song[0]), cover, loudness)
+                    elif isinstance(filename, str):
+                        filename = filename.replace('*', youtube.make_filename(song[0]))
+                        if dl_video.parallel:
+                            youtube.convert_parallel(song[1], filename, bitrate, tags=metadata, cover=cover,
+                                                     loudness=loudness)
+                        else:
+                            youtube.convert(song[1], filename, bitrate=bitrate, tags=metadata, cover=cover,
+                                            loudness=loudness)
+                    else:
+                        filename = [name.replace('*', youtube.make_filename(song[0])) for name in filename]
+                        youtube.convert_many(song[1], filename, bitrate, metadata, cover, loudness)
                     print("Done")
                     return True
                 except (IOError, RuntimeError) as e:
@@ -123,10 +781,54 @@ def dl_video(videoId: str=None, filename: str=None):
         finally:
             if song:
                 remove(song[1])
+            if cover:
+                remove(cover)
     return False
 
 
-def dl_playlist(playlistId: str='', filename: str=None):
+dl_video.parallel = False
+dl_video.split = None
+
+
+def video_chapters(videoId: str, filename: str, source: str):
+    # Throws IOError, RuntimeError
+    """Return the chapters to split the audio of `videoId`, downloaded into `filename`, into (see youtube.split).
+    If `source` is 'chapters', they are the chapters of the file, or else the timestamps of the video description;
+    otherwise `source` is the path of a cue sheet (.cue), or of a text file with a timestamp and a title per line."""
+    if source != 'chapters':
+        with open(source, encoding='utf-8') as f:
+            return youtube.parse_cue(f.read()) if source.lower().endswith('.cue') else \
+                youtube.parse_timestamps(f.read())
+
+    chapters = youtube.probe_chapters(filename)
+    if not chapters:
+        try:
+            videoId = youtube.parseVideoId(videoId)
+        except ValueError:
+            #Already an id
+            pass
+        video = youtube.get_video_details([videoId], 'snippet').get(videoId)
+        chapters = youtube.parse_timestamps(video['snippet']['description']) if video else []
+    return chapters
+
+
+def dl_playlist(playlistId: str='', filename=None, sync: bool=False, prune: bool=False, pipe: bool=False,
+                bitrate: "bits per second"=None, cancel: Event=None, progress: dict=None):
+    """Download every song of a playlist.
+    `filename` may be a list of filenames, every song is then written to each of them by a single ffmpeg process
+    (in which case `pipe` is ignored).
+    If `sync` is True, songs recorded in the manifest of the target directory are skipped
+    before anything is downloaded, and the manifest is updated with the new songs.
+    If `prune` is also True, songs which were removed from the playlist are deleted.
+    If `pipe` is True, downloads are piped into ffmpeg without tmp files.
+    If `bitrate` is given, it is the bitrate to transcode at.
+    If dl_playlist.store is True, songs found in the store are linked instead of downloaded (see take_from_store).
+    If dl_playlist.longest_first is True, the durations of the pending songs are looked up page by page while the
+    playlist is listed, and the longest of the songs listed ahead is processed first (see prefetch and run_pipeline);
+    otherwise songs are processed in playlist order.
+    Once `cancel` is set, no new song is started (nor pruned), and songs in progress are finished.
+    `progress`, if given, is updated with the counts of synced, pending and done songs as they change.
+    Return True if every pending song succeeded."""
     url = False
     fnameParam = not not filename
     while True:
@@ -144,51 +846,592 @@ def dl_playlist(playlistId: str='', filename: str=None):
                     continue
 
         print("Downloading playlist...")
-        playlist = youtube.get_playlist(playlistId)
-        playlistTitle = youtube.get_playlist_title(playlistId)
-        if playlist is None or playlistTitle is None:
-            if not url:
-                return False
-            else:
-                print("Invalid playlist URL")
-                playlistId = ''
-                continue
-        print("Playlist title: {0} ({1} songs)".format(playlistTitle, len(playlist)))
-        playlistTitle = youtube.make_filename(playlistTitle)
-        if not filename:
-            print("Target filename (must have extension matching a supported format)\n"
-                  "Use * to expand to video title (e.g 'D:\\*.mp3')\n"
-                  "Use ? to expand to playlist title (e.g. 'D:\\?\\*.mp3 to save every song \n"
-                  "with its video title in a new folder with the playlist's name) | [Enter] - Cancel")
-        while True:
+        #The playlist pages are fetched in the background, while the title is looked up
+        #and then while the first songs are downloaded
+        #With their position in the playlist
+        stop = Event()
+        playlist = prefetch(enumerate(youtube.iter_playlist(playlistId), 1), dl_playlist.prefetch_size, stop=stop)
+        try:
+            playlistTitle = youtube.get_playlist_title(playlistId)
+            if playlistTitle is None:
+                if not url:
+                    return False
+                else:
+                    print("Invalid playlist URL")
+                    playlistId = ''
+                    continue
+            print("Playlist title: {0}".format(playlistTitle))
+            album = playlistTitle
+            playlistTitle = youtube.make_filename(playlistTitle)
             if not filename:
-                filename = input("Filename: ")
+                print("Target filename (must have extension matching a supported format)\n"
+                      "Use * to expand to video title (e.g 'D:\\*.mp3')\n"
+                      "Use ? to expand to playlist title (e.g. 'D:\\?\\*.mp3 to save every song \n"
+                      "with its video title in a new folder with the playlist's name) | [Enter] - Cancel")
+            while True:
                 if not filename:
-                    break
-
-            target_format = ''
-            for fmt in youtube.convert.supported:
-                if filename.endswith('.' + fmt):
-                    target_format = fmt
+                    filename = input("Filename: ")
+                    if not filename:
+                        break
 
-            if not target_format:
-                print("unsupported format")
-                if not fnameParam:
+                filenames = [filename] if isinstance(filename, str) else list(filename)
+                target_formats = [output_format(name) for name in filenames]
+                if not all(target_formats):
+                    print("unsupported format")
+                    if fnameParam:
+                        return False
+                    filename = None
                     continue
+                #With several targets, streams are chosen for the first one
+                target_format = target_formats[0]
+
+                filenames = [name.replace('?', playlistTitle) for name in filenames]
+                #Each target directory has its own manifest, shared by the targets in it
+                loaded = dict()
+                if sync:
+                    for name in filenames:
+                        if manifest_path(name) not in loaded:
+                            loaded[manifest_path(name)] = load_manifest(manifest_path(name))
+                manifests = [loaded.get(manifest_path(name), dict()) for name in filenames]
+                manifest_lock = Lock()
+                seen = set()
+                #videoId -> tags of its position in the playlist
+                tracks = dict()
+                counts = progress if progress is not None else dict()
+                counts.update(synced=0, pending=0, done=0)
+
+                def select(item):
+                    track, videoId = item
+                    seen.add(videoId)
+                    tracks.setdefault(videoId, {'album': album, 'track': track})
+                    if sync and all(is_synced(manifest_lookup(manifest, videoId, name) or dict(), fmt)
+                                    for manifest, name, fmt in zip(manifests, filenames, target_formats)):
+                        counts['synced'] += 1
+                        return None
+                    counts['pending'] += 1
+                    return videoId
+
+                #Songs are handed to the pipeline as soon as their page arrives, until `cancel` is set
+                listed = itertools.takewhile(lambda item: cancel is None or not cancel.is_set(), playlist)
+                durations = dict()
+                if dl_playlist.longest_first:
+                    #The longest of the pending songs listed so far first, once synced songs are skipped
+                    pending = prefetch(with_durations(listed, durations, select), dl_playlist.prefetch_size,
+                                       lambda videoId: -durations.get(videoId, 0), stop)
                 else:
-                    break
+                    pending = (videoId for videoId in map(select, listed) if videoId is not None)
 
-            filename = filename.replace('?', playlistTitle)
-            print("Downloading songs...")
-            pool.map(functools.partial(work_on_song, filename=filename, target_format=target_format), playlist)
-            print("Done. {0}/{1} succeeded".format(work_on_song.success_count, len(playlist)))
-            return True
+                def record(videoId, targets):
+                    if targets:
+                        with manifest_lock:
+                            counts['done'] += 1
+                    if targets and sync:
+                        entries = [manifest_entry(target, fmt) for target, fmt in zip(targets, target_formats)]
+                        with manifest_lock:
+                            for manifest, name, entry in zip(manifests, filenames, entries):
+                                manifest[manifest_key(videoId, name)] = entry
+                                #Only drop an entry keyed by videoId alone once its file is recorded under a target
+                                if manifest.get(videoId, dict()).get('path') == entry['path']:
+                                    del manifest[videoId]
+
+                def transcode(fetched):
+                    record(fetched[0], finish_song(fetched, filenames, target_format, bitrate, tags=tracks[fetched[0]]))
+
+                if pipe and len(filenames) == 1 and not song_loudness.enabled:
+                    #Piped songs are downloaded and transcoded at once, at the pace of the download
+                    def download(videoId):
+                        record(videoId, pipe_song(videoId, filenames[0], target_format, bitrate, tracks[videoId]))
+                elif dl_playlist.store:
+                    #Songs already converted for another playlist (or by another worker) are only materialised
+                    def download(videoId):
+                        started = time.time()
+                        try:
+                            with youtube.tracking(videoId):
+                                title, keys = store_keys(videoId, target_formats, bitrate, tracks[videoId])
+                            while True:
+                                targets = take_from_store(videoId, title, keys, filenames, started)
+                                if targets:
+                                    record(videoId, targets)
+                                    return None
+                                if claim_song(keys):
+                                    break
+                        except (IOError, RuntimeError, ValueError, OSError) as e:
+                            with work_on_song.lock:
+                                print("WARNING: failed to download " + videoId + ": " + str(e))
+                            report_track(videoId, started, error=str(e))
+                            return None
+                        #Whatever happens, the claim is released unless the song is handed to transcode, so that
+                        #the workers waiting for it don't wait forever
+                        try:
+                            fetched = fetch_song(videoId, target_format, bitrate)
+                        except BaseException:
+                            release_song(keys)
+                            raise
+                        if not fetched:
+                            release_song(keys)
+                            return None
+                        return fetched + (keys,)
+
+                    def transcode(fetched):
+                        try:
+                            record(fetched[0], finish_song(fetched[:3], filenames, target_format, bitrate, fetched[3],
+                                                           tracks[fetched[0]]))
+                        finally:
+                            release_song(fetched[3])
+                else:
+                    download = functools.partial(fetch_song, target_format=target_format, bitrate=bitrate)
+
+                print("Downloading songs...")
+                try:
+                    controller = AdaptiveConcurrency(dl_playlist.download_workers, dl_playlist.transcode_workers) \
+                        if dl_playlist.adaptive else None
+                    run_pipeline(pending, download, transcode, dl_playlist.download_workers,
+                                 dl_playlist.transcode_workers, dl_playlist.queue_size, controller,
+                                 (lambda videoId: -durations.get(videoId, 0)) if dl_playlist.longest_first else None)
+                    #Only prune once the whole playlist has been enumerated
+                    if sync and prune and not (cancel is not None and cancel.is_set()):
+                        for manifest in loaded.values():
+                            for key in [key for key in manifest if key.split(':')[0] not in seen]:
+                                try:
+                                    remove(manifest[key]['path'])
+                                    print("Removed " + manifest[key]['path'])
+                                except (OSError, IOError, KeyError):
+                                    pass
+                                del manifest[key]
+                finally:
+                    for path, manifest in loaded.items():
+                        save_manifest(path, manifest)
+                if sync:
+                    print("{0}/{1} songs already synced".format(counts['synced'], len(seen)))
+                #The counts of this playlist, whatever the other playlists downloading at the same time
+                print("Done. {0}/{1} succeeded".format(counts['done'], counts['pending']))
+                return counts['done'] == counts['pending']
+        finally:
+            #Stop listing the playlist if it isn't listed to the end (e.g. once cancelled)
+            stop.set()
 
     return False
 
 
+#Downloads are network-bound, so there are more download workers than cores
+#ffmpeg is CPU-bound, so there is one transcode worker per core
+dl_playlist.transcode_workers = os.cpu_count() or 1
+dl_playlist.download_workers = 2 * dl_playlist.transcode_workers
+#Maximum number of downloaded files waiting to be transcoded
+dl_playlist.queue_size = dl_playlist.transcode_workers
+#Maximum number of videoIds enumerated ahead of the downloaders
+dl_playlist.prefetch_size = 200
+#Convert each song once for every playlist, see youtube.store_add
+dl_playlist.store = False
+#Adjust the number of workers while the playlist downloads, see AdaptiveConcurrency
+dl_playlist.adaptive = False
+#Process the longest of the songs listed ahead first, so that the workers finish together, see prefetch
+dl_playlist.longest_first = True
+
+
+def read_manifest(manifest: str):
+    # Throws IOError, ValueError
+    """Return the entries of the batch manifest file `manifest`, as dictionaries with keys
+    url, path (list of filenames, empty to use the default), priority (higher first) and bitrate (kbps or None).
+    A manifest is either a JSON lines file (.jsonl or .json) of objects with these keys (path may be a string),
+    a CSV file (.csv) with a header and these columns (one path per row, use several rows for several paths),
+    or a text file with a url, optionally followed by a path, per line.
+    Blank lines and lines starting with # are ignored."""
+    entries = []
+    with open(manifest, newline='', encoding='utf-8') as f:
+        if manifest.endswith('.csv'):
+            rows = [row for row in csv.DictReader(f) if (row.get('url') or '').strip()]
+        elif manifest.endswith('.jsonl') or manifest.endswith('.json'):
+            rows = [json.loads(line) for line in f if line.strip() and not line.lstrip().startswith('#')]
+        else:
+            rows = [dict(zip(('url', 'path'), line.strip().split(None, 1)))
+                    for line in f if line.strip() and not line.lstrip().startswith('#')]
+    for row in rows:
+        path = row.get('path') or []
+        entries.append({'url': row['url'].strip(),
+                        'path': [path.strip()] if isinstance(path, str) else list(path),
+                        'priority': int(row.get('priority') or 0),
+                        'bitrate': int(row['bitrate']) if row.get('bitrate') else None})
+    return entries
+
+
+def dl_batch(manifest: str, filename=None, bitrate: "bits per second"=None):
+    """Download every video and playlist listed in the batch manifest `manifest` (see read_manifest)
+    through a single pipeline.
+    `filename` (a filename or a list of filenames) is used for the entries without a path,
+    and `bitrate` for the entries without a bitrate.
+    Playlists are enumerated first, then each video is downloaded once whatever the number of entries
+    listing it, and converted by a single ffmpeg process into the targets of all of them, each at the bitrate
+    of its entry.
+    Videos are processed by decreasing priority (the highest priority of their entries), then longest first
+    if dl_playlist.longest_first is True, then in manifest order."""
+    try:
+        entries = read_manifest(manifest)
+    except (IOError, ValueError, KeyError, csv.Error) as e:
+        print("Invalid manifest: " + str(e))
+        return False
+
+    default = [filename] if isinstance(filename, str) else list(filename or [])
+    #videoId -> {'targets', 'bitrates' (of each target), 'priority', 'order', 'tags'}
+    videos = dict()
+    playlists = []
+
+    def add(videoId, targets, priority, rate, tags=None):
+        #A video listed by several playlists is tagged as a track of the first one
+        video = videos.setdefault(videoId, {'targets': [], 'bitrates': [], 'priority': priority,
+                                            'order': len(videos), 'tags': tags})
+        for target in targets:
+            if target not in video['targets']:
+                video['targets'].append(target)
+                video['bitrates'].append(rate)
+        video['priority'] = max(video['priority'], priority)
+
+    for entry in entries:
+        targets = entry['path'] or default
+        if not targets or not all(output_format(target) for target in targets):
+            print("WARNING: no path with a supported format for " + entry['url'])
+            continue
+        rate = entry['bitrate'] * 1000 if entry['bitrate'] else bitrate
+        try:
+            add(youtube.parseVideoId(entry['url']), targets, entry['priority'], rate)
+        except ValueError:
+            try:
+                playlists.append((youtube.parsePlaylistId(entry['url']), targets, entry['priority'], rate))
+            except ValueError as e:
+                print("WARNING: " + entry['url'] + ": " + str(e))
+
+    if playlists:
+        print("Enumerating {0} playlists...".format(len(playlists)))
+        try:
+            titles = youtube.get_playlist_titles(set(playlist[0] for playlist in playlists))
+            contents = youtube.get_playlists(titles)
+        except IOError as e:
+            print(e)
+            return False
+        for playlistId, targets, priority, rate in playlists:
+            if playlistId not in titles:
+                print("WARNING: playlist " + playlistId + " is unavailable")
+                continue
+            title = youtube.make_filename(titles[playlistId])
+            for track, videoId in enumerate(contents[playlistId], 1):
+                add(videoId, [target.replace('?', title) for target in targets], priority, rate,
+                    {'album': titles[playlistId], 'track': track})
+
+    durations = song_durations(list(videos)) if dl_playlist.longest_first else dict()
+
+    def rank(item):
+        videoId, video = item
+        return -video['priority'], -durations.get(videoId, 0), video['order']
+
+    items = sorted(videos.items(), key=rank)
+
+    def download(item):
+        videoId, video = item
+        fetched = fetch_song(videoId, output_format(video['targets'][0]), stream_bitrate(video['bitrates']))
+        return (fetched, item) if fetched else None
+
+    def transcode(result):
+        fetched, (videoId, video) = result
+        finish_song(fetched, video['targets'], output_format(video['targets'][0]), video['bitrates'],
+                    tags=video['tags'])
+
+    print("Downloading {0} songs...".format(len(items)))
+    work_on_song.success_count = 0
+    controller = AdaptiveConcurrency(dl_playlist.download_workers, dl_playlist.transcode_workers) \
+        if dl_playlist.adaptive else None
+    run_pipeline(items, download, transcode, dl_playlist.download_workers, dl_playlist.transcode_workers,
+                 dl_playlist.queue_size, controller, rank)
+    print("Done. {0}/{1} succeeded".format(work_on_song.success_count, len(items)))
+    return work_on_song.success_count == len(items)
+
+
+def run_job(job: dict, cancel: Event):
+    # Throws IOError, RuntimeError, ValueError
+    """Run `job` (see add_job) in the current thread and return True if it succeeded.
+    The counts of pending and done songs of the job are kept in its progress."""
+    if job['kind'] == 'video':
+        job['progress'].update(pending=1, done=0)
+        ok = dl_video(youtube.parseVideoId(job['url']), job['path'], job.get('pipe', False), job.get('bitrate'))
+        job['progress']['done'] = int(ok)
+        return ok
+    if job['kind'] == 'playlist':
+        return dl_playlist(youtube.parsePlaylistId(job['url']), job['path'], job.get('sync', False),
+                           job.get('prune', False), job.get('pipe', False), job.get('bitrate'), cancel, job['progress'])
+    youtube.convert_many(job['input'], job['path'], job.get('bitrate'))
+    return True
+
+
+def add_job(request: dict):
+    # Throws ValueError
+    """Queue a job for the daemon's job workers and return it.
+    `request` has a key kind: 'video' or 'playlist' (with a key url) or 'convert' (with a key input),
+    a key path (a filename or a list of filenames, as for dl_video and dl_playlist),
+    and optionally keys bitrate (bits per second), pipe, sync and prune.
+    Paths must be absolute: the daemon's working directory isn't the submitter's.
+    The job returned is `request` with keys id, state ('queued', 'running', 'done', 'failed' or 'cancelled'),
+    progress (see dl_playlist), error and the submitted, started and finished times added."""
+    if request.get('kind') not in ('video', 'playlist', 'convert'):
+        raise ValueError("kind must be video, playlist or convert")
+    if not isinstance(request.get('input' if request['kind'] == 'convert' else 'url'), str):
+        raise ValueError(("input" if request['kind'] == 'convert' else "url") + " is required")
+    path = request.get('path')
+    path = [path] if isinstance(path, str) else path
+    if not path or not isinstance(path, list) or not all(isinstance(name, str) and name for name in path):
+        raise ValueError("path is required")
+    if not all(os.path.isabs(name) for name in path + ([request['input']] if request['kind'] == 'convert' else [])):
+        raise ValueError("paths must be absolute")
+    if not all(output_format(name) for name in path):
+        raise ValueError("unsupported format, path must end with one of: " + ', '.join(youtube.convert.supported))
+
+    with add_job.lock:
+        add_job.next_id += 1
+        job = dict(request, id=str(add_job.next_id), path=path, state='queued', progress=dict(), error=None,
+                   submitted=time.time(), started=None, finished=None)
+        add_job.jobs[job['id']] = job
+        add_job.cancel[job['id']] = Event()
+        #Forget the oldest finished jobs
+        finished = [other['id'] for other in add_job.jobs.values() if other['finished'] is not None]
+        for jobId in finished[:max(0, len(finished) - add_job.history)]:
+            del add_job.jobs[jobId]
+            del add_job.cancel[jobId]
+    add_job.queue.put(job['id'])
+    return job
+
+
+add_job.lock = Lock()
+add_job.next_id = 0
+add_job.jobs = dict()
+add_job.cancel = dict()
+add_job.queue = Queue()
+#Number of finished jobs whose status is kept
+add_job.history = 1000
+
+
+def get_job(jobId: str):
+    """Return a snapshot of the job `jobId`, or None if there is no such job."""
+    with add_job.lock:
+        job = add_job.jobs.get(jobId)
+        return json.loads(json.dumps(job)) if job else None
+
+
+def cancel_job(jobId: str):
+    """Cancel the job `jobId`: a queued job won't run, and a running playlist stops starting new songs.
+    Return the job, or None if there is no such job."""
+    with add_job.lock:
+        job = add_job.jobs.get(jobId)
+        if not job:
+            return None
+        add_job.cancel[jobId].set()
+        if job['state'] == 'queued':
+            job['state'] = 'cancelled'
+            job['finished'] = time.time()
+    return get_job(jobId)
+
+
+def job_worker():
+    """Run the queued jobs one after the other, forever."""
+    while True:
+        jobId = add_job.queue.get()
+        with add_job.lock:
+            job = add_job.jobs.get(jobId)
+            if not job or job['state'] != 'queued':
+                continue
+            job['state'] = 'running'
+            job['started'] = time.time()
+            cancel = add_job.cancel[jobId]
+        try:
+            ok, error = run_job(job, cancel), None
+        except Exception as e:
+            ok, error = False, str(e)
+        with add_job.lock:
+            progress = job['progress']
+            if not ok and error is None and progress.get('pending'):
+                error = "{0}/{1} songs failed".format(progress['pending'] - progress.get('done', 0),
+                                                        progress['pending'])
+            #Only playlists stop early when cancelled, other jobs run to the end once started
+            job['state'] = 'cancelled' if cancel.is_set() and job['kind'] == 'playlist' else \
+                'done' if ok else 'failed'
+            job['error'] = error
+            job['finished'] = time.time()
+
+
+def daemon_token():
+    # Throws IOError
+    """Return the token which requests to the daemon must carry, stored in the cache directory
+    (and created on first use) so that only local users who can read it, and no web page, can submit jobs."""
+    path = os.path.join(youtube._cache_dir, daemon_token.name)
+    try:
+        with open(path) as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    os.makedirs(youtube._cache_dir, exist_ok=True)
+    token = secrets.token_hex(16)
+    with os.fdopen(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        f.write(token)
+    os.replace(path + '.tmp', path)
+    return token
+
+
+daemon_token.name = 'daemon-token'
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """Local JSON API of the daemon:
+    POST /jobs submits a job (see add_job), GET /jobs lists the jobs,
+    GET /jobs/<id> returns a job and DELETE /jobs/<id> cancels it.
+    Requests must carry the token of the daemon (see daemon_token) as a bearer token, be addressed to a local host
+    name and have no foreign Origin (against DNS rebinding and cross-site requests), and POST bodies must be
+    sent as application/json."""
+
+    token = None
+    hosts = ('127.0.0.1', 'localhost', '::1')
+
+    def authorized(self):
+        host = urlparse('//' + (self.headers.get('Host') or '')).hostname
+        origin = self.headers.get('Origin')
+        if host not in self.hosts + (self.server.server_address[0],) or \
+                (origin is not None and urlparse(origin).netloc != self.headers.get('Host')):
+            self.reply(403, {'error': 'forbidden'})
+            return False
+        if not self.token or not hmac.compare_digest(self.headers.get('Authorization') or '', 'Bearer ' + self.token):
+            self.reply(401, {'error': 'invalid token'})
+            return False
+        return True
+
+    def reply(self, code: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply_job(self, job):
+        if job:
+            self.reply(200, job)
+        else:
+            self.reply(404, {'error': 'no such job'})
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') == '/jobs':
+            with add_job.lock:
+                jobIds = list(add_job.jobs)
+            self.reply(200, [job for job in map(get_job, jobIds) if job])
+        elif self.path.startswith('/jobs/'):
+            self.reply_job(get_job(self.path[len('/jobs/'):]))
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'not found'})
+        if (self.headers.get('Content-Type') or '').split(';')[0].strip().lower() != 'application/json':
+            return self.reply(415, {'error': 'jobs must be sent as application/json'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError("a job must be a JSON object")
+            self.reply(201, add_job(request))
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        if not self.path.startswith('/jobs/'):
+            return self.reply(404, {'error': 'not found'})
+        self.reply_job(cancel_job(self.path[len('/jobs/'):]))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(address: str, workers: int=None):
+    """Run the daemon: serve the job API (see JobHandler) on `address` (host:port) until interrupted,
+    running jobs in `workers` threads (serve.workers by default). Imports, HTTP connections,
+    the stream cache and the login stay warm between jobs."""
+    host, port = address.rsplit(':', 1)
+    JobHandler.token = daemon_token()
+    server = ThreadingHTTPServer((host, int(port)), JobHandler)
+    for _ in range(max(1, workers or serve.workers)):
+        Thread(target=job_worker, daemon=True).start()
+    print("Listening on http://{0}:{1}/jobs".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return True
+
+
+#Playlist jobs are parallel on their own, a few workers keep small jobs from waiting behind a long one
+serve.workers = 4
+serve.address = '127.0.0.1:8765'
+
+
+def request_daemon(method: str, path: str, body=None):
+    # Throws IOError
+    """Send a request to the daemon listening on request_daemon.address, and return its decoded JSON reply."""
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request('http://' + request_daemon.address + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json',
+                                              'Authorization': 'Bearer ' + daemon_token()})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise IOError(json.loads(e.read() or b'{}').get('error') or str(e))
+
+
+request_daemon.address = serve.address
+
+
+def submit(request: dict, wait: bool=True):
+    # Throws IOError
+    """Submit a job to the daemon (see add_job). If `wait` is True, wait until the job is finished.
+    Relative paths of `request` are resolved against the current directory. Return the job."""
+    request = dict(request)
+    path = request.get('path')
+    if isinstance(path, str):
+        request['path'] = os.path.abspath(path)
+    elif isinstance(path, list):
+        request['path'] = [os.path.abspath(name) for name in path]
+    if isinstance(request.get('input'), str):
+        request['input'] = os.path.abspath(request['input'])
+    job = request_daemon('POST', '/jobs', request)
+    print("Submitted job " + job['id'])
+    while wait and job['finished'] is None:
+        time.sleep(submit.poll_interval)
+        job = request_daemon('GET', '/jobs/' + job['id'])
+    return job
+
+
+submit.poll_interval = 0.5
+
+
+def submit_cli(request: dict, wait: bool):
+    """Submit a job from the command line, and return the exit code."""
+    try:
+        job = submit(request, wait)
+    except IOError as e:
+        print(e)
+        return 1
+    if job['error']:
+        print(job['error'])
+    print("Job {0} {1}".format(job['id'], job['state']))
+    return 0 if job['state'] in ('queued', 'running', 'done') else 1
+
+
 def choose_from_my():
-    if youtube.login.username:
+    if youtube.current_user():
         print("Choose a playlist from the list (by number):")
         playlists = youtube.get_my_playlists()
         if not playlists:
@@ -225,8 +1468,8 @@ def download():
                                            ("&Playlist", functools.partial(menu, None, [
                                                ("Youtube &Playlist URL", dl_playlist),
                                                # ("M3&U Playlist",)
-                                               ("&My youtube playlists [" + youtube.login.username + "]",
-                                                choose_from_my) if youtube.login.username else
+                                               ("&My youtube playlists [" + youtube.current_user() + "]",
+                                                choose_from_my) if youtube.current_user() else
                                                ("&My youtube playlists [requires login]", prompt_login)]))])
     return
 
@@ -237,7 +1480,7 @@ def convert():
 
 def login():
     if youtube.login():
-        print("Successfully authenticated as " + youtube.login.username)
+        print("Successfully authenticated as " + youtube.current_user())
     else:
         print("Access was denied. Not logged in")
     return
@@ -256,35 +1499,173 @@ def main():
     try:
         if len(sys.argv) == 1:
             print("Youtube Downloader - v1.0.0 - Python 3")
-            print("Not logged in" if not youtube.login.username else "Logged in as " + youtube.login.username)
+            print("Not logged in" if not youtube.current_user() else "Logged in as " + youtube.current_user())
             while menu("What do you want to do?", [("&Download", download),
                                                    # ("&Convert", convert),
-                                                   ("&Logout [logged in as " + youtube.login.username + "]",
-                                                    youtube.logout) if youtube.login.username else
+                                                   ("&Logout [logged in as " + youtube.current_user() + "]",
+                                                    youtube.logout) if youtube.current_user() else
                                                    ("&Login", login)]): pass
             return 0
 
         else:
-            parser = argparse.ArgumentParser(description='Download a video')
-            parser.add_argument(dest='url', type=str,
-                                help='url of video to download')
-            parser.add_argument(dest='path', type=str,
-                                help="path to save the video into\n"
+            parser = argparse.ArgumentParser(description='Download a video or a playlist')
+            parser.add_argument(dest='url', type=str, nargs='?',
+                                help='url of video or playlist to download')
+            parser.add_argument(dest='path', type=str, nargs='*',
+                                help="path to save the video into; several paths are all written "
+                                     "by a single ffmpeg process (e.g. 'D:\\*.mp3' 'D:\\*.opus')\n"
                                      "Target filename (must have extension matching a supported format)\n"
                                      "Use * to expand to video title (e.g 'D:\\*.mp3')\n"
                                      "Use ? to expand to playlist title (e.g. 'D:\\?\\*.mp3 to save every song \n"
                                      "with its video title in a new folder with the playlist's name) | [Enter] - Cancel"
                                 )
+            parser.add_argument('--sync', action='store_true',
+                                help='only download songs of the playlist which are missing from the target directory')
+            parser.add_argument('--prune', action='store_true',
+                                help='with --sync, delete songs which were removed from the playlist')
+            parser.add_argument('--pipe', action='store_true',
+                                help='pipe downloads straight into ffmpeg instead of going through tmp files')
+            parser.add_argument('--tags', action='store_true',
+                                help='tag songs with their title and author, and with the playlist title '
+                                     'and their position as album and track number')
+            parser.add_argument('--cover', action='store_true',
+                                help='attach the video thumbnail to songs as cover art (mp3, m4a and flac)')
+            parser.add_argument('--normalize', action='store_true',
+                                help='normalize the loudness of songs (EBU R128), analyzing each stream once '
+                                     'and converting it in a single pass')
+            parser.add_argument('--parallel-transcode', action='store_true',
+                                help='when downloading a video to a single path, encode long tracks in time slices '
+                                     'on every CPU (mp3 only)')
+            parser.add_argument('--split', type=str, metavar='SOURCE',
+                                help="when downloading a video, write one file per chapter, with * expanding to the "
+                                     "chapter title; SOURCE is 'chapters' (the chapters of the video, or the "
+                                     "timestamps of its description), a cue sheet (.cue) or a text file with "
+                                     "a timestamp and a title per line")
+            parser.add_argument('--download-workers', type=int, default=dl_playlist.download_workers,
+                                help='number of concurrent downloads when downloading a playlist')
+            parser.add_argument('--transcode-workers', type=int, default=dl_playlist.transcode_workers,
+                                help='number of concurrent ffmpeg processes when downloading a playlist')
+            parser.add_argument('--queue-size', type=int, default=dl_playlist.queue_size,
+                                help='maximum number of downloaded songs waiting to be transcoded')
+
+            parser.add_argument('--playlist-order', action='store_true',
+                                help='process songs in playlist order, instead of the longest of the songs '
+                                     'listed ahead first')
+            parser.add_argument('--adaptive', action='store_true',
+                                help='adjust the number of download and transcode workers to the observed throughput, '
+                                     'throttling and CPU load, starting from --download-workers/--transcode-workers')
+            parser.add_argument('--download-range', type=str, metavar='MIN:MAX',
+                                default='{0}:{1}'.format(*AdaptiveConcurrency.download_range),
+                                help='with --adaptive, bounds of the number of download workers')
+            parser.add_argument('--transcode-range', type=str, metavar='MIN:MAX',
+                                default='{0}:{1}'.format(*AdaptiveConcurrency.transcode_range),
+                                help='with --adaptive, bounds of the number of transcode workers')
+
+            parser.add_argument('--quota-budget', type=int,
+                                help='daily YouTube Data API quota units this run may use; '
+                                     'requests which would exceed it fail instead of being sent')
+
+            parser.add_argument('--stream-policy', choices=sorted(youtube.select_stream.policies),
+                                default=youtube.select_stream.policy,
+                                help='how to choose the audio stream to download, see youtube.select_stream')
+            parser.add_argument('--bitrate', type=int,
+                                help='bitrate (kbps) to transcode at; with the smallest/balanced stream policies, '
+                                     'streams with at least this bitrate are preferred')
+            parser.add_argument('--store', action='store_true',
+                                help='keep converted songs in a local store, so that songs shared by several '
+                                     'playlists are downloaded and converted once, then linked into each of them')
+            parser.add_argument('--store-size', type=int, default=youtube.store_gc.max_size >> 20,
+                                help='maximum size (MB) of the store; the least recently used songs are removed')
+            parser.add_argument('--metrics', type=str,
+                                help='write timing events of every track and stage to this file, '
+                                     'as JSON lines, or in the Prometheus text format if it ends with .prom')
+
+            parser.add_argument('--batch', type=str, metavar='MANIFEST',
+                                help='download every video and playlist listed in a manifest (.txt, .jsonl or .csv) '
+                                     'in a single pipeline; path is then the default path of the entries')
+            parser.add_argument('--daemon', action='store_true',
+                                help='keep running and serve download jobs on --address, see --submit')
+            parser.add_argument('--submit', action='store_true',
+                                help='submit the download as a job to the daemon on --address, and wait for it '
+                                     '(the settings of the daemon apply, except for --sync, --prune, --pipe '
+                                     'and --bitrate)')
+            parser.add_argument('--no-wait', action='store_true',
+                                help="with --submit, don't wait for the job to finish")
+            parser.add_argument('--jobs', action='store_true',
+                                help='list the jobs of the daemon on --address')
+            parser.add_argument('--cancel', type=str, metavar='JOB',
+                                help='cancel a job of the daemon on --address')
+            parser.add_argument('--address', type=str, default=serve.address,
+                                help='host:port of the daemon (default %(default)s)')
 
             args = parser.parse_args()
+            request_daemon.address = args.address
+            if args.jobs or args.cancel:
+                try:
+                    jobs = request_daemon('GET', '/jobs') if args.jobs else \
+                        [request_daemon('DELETE', '/jobs/' + args.cancel)]
+                    for job in jobs:
+                        print(json.dumps(job))
+                except IOError as e:
+                    print(e)
+                    return 1
+                return 0
+            if args.batch:
+                #Without a url, the only positional argument given is the default path
+                paths = ([args.url] if args.url else []) + args.path
+            elif not args.daemon and (not args.url or not args.path):
+                parser.error('url and path are required')
+            if args.pipe and len(args.path) > 1:
+                print("--pipe supports a single path")
+                return 1
+            if args.pipe and args.normalize:
+                print("--pipe can't be used with --normalize")
+                return 1
+            youtube.select_stream.policy = args.stream_policy
+            youtube.YoutubeDataApi.quota_budget = args.quota_budget
+            bitrate = args.bitrate * 1000 if args.bitrate else None
+            if args.metrics:
+                if args.metrics.endswith('.prom'):
+                    youtube.add_listener(youtube.PrometheusExporter(args.metrics))
+                else:
+                    youtube.add_listener(youtube.JsonLinesExporter(open(args.metrics, 'a', encoding='utf-8')))
+            dl_playlist.download_workers = args.download_workers
+            dl_playlist.transcode_workers = args.transcode_workers
+            dl_playlist.queue_size = args.queue_size
+            dl_playlist.adaptive = args.adaptive
+            dl_playlist.longest_first = not args.playlist_order
+            AdaptiveConcurrency.download_range = tuple(int(n) for n in args.download_range.split(':'))
+            AdaptiveConcurrency.transcode_range = tuple(int(n) for n in args.transcode_range.split(':'))
+            dl_playlist.store = args.store
+            dl_video.parallel = args.parallel_transcode
+            dl_video.split = args.split
+            song_tags.enabled = args.tags
+            song_cover.enabled = args.cover
+            song_loudness.enabled = args.normalize
+            youtube.store_gc.max_size = args.store_size << 20
+            if args.daemon:
+                return 0 if serve(args.address) else 1
+            if args.batch:
+                return 0 if dl_batch(args.batch, paths, bitrate) else 1
             try:
                 videoId = youtube.parseVideoId(args.url)
-            except ValueError as e:
-                print(e)
-                return 1
+            except ValueError:
+                try:
+                    playlistId = youtube.parsePlaylistId(args.url)
+                except ValueError as e:
+                    print(e)
+                    return 1
+                if args.submit:
+                    return submit_cli({'kind': 'playlist', 'url': args.url, 'path': args.path, 'sync': args.sync,
+                                       'prune': args.prune, 'pipe': args.pipe, 'bitrate': bitrate}, not args.no_wait)
+                return 0 if dl_playlist(playlistId, args.path, args.sync, args.prune, args.pipe, bitrate) else 1
+
+            if args.submit:
+                return submit_cli({'kind': 'video', 'url': args.url, 'path': args.path, 'pipe': args.pipe,
+                                   'bitrate': bitrate}, not args.no_wait)
 
             print(args)
-            return 0 if dl_video(videoId, args.path) else 1
+            return 0 if dl_video(videoId, args.path, args.pipe, bitrate) else 1
     finally:
         youtube.__end__()
 
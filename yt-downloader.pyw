@@ -189,7 +189,7 @@ def dl_playlist(playlistId: str='', filename: str=None):
 
 
 def choose_from_my():
-    if youtube.login.username:
+    if youtube.current_user():
         print("Choose a playlist from the list (by number):")
         playlists = youtube.get_my_playlists()
         if not playlists:
@@ -226,8 +226,8 @@ def download():
                                            ("&Playlist", functools.partial(menu, None, [
                                                ("Youtube &Playlist URL", dl_playlist),
                                                # ("M3&U Playlist",)
-                                               ("&My youtube playlists [" + youtube.login.username + "]",
-                                                choose_from_my) if youtube.login.username else
+                                               ("&My youtube playlists [" + youtube.current_user() + "]",
+                                                choose_from_my) if youtube.current_user() else
                                                ("&My youtube playlists [requires login]", prompt_login)]))])
     return
 
@@ -238,7 +238,7 @@ def convert():
 
 def login():
     if youtube.login():
-        print("Successfully authenticated as " + youtube.login.username)
+        print("Successfully authenticated as " + youtube.current_user())
     else:
         print("Access was denied. Not logged in")
     return
@@ -257,11 +257,11 @@ def main():
     try:
         if len(sys.argv) == 1:
             print("Youtube Downloader - v1.0.0 - Python 3")
-            print("Not logged in" if not youtube.login.username else "Logged in as " + youtube.login.username)
+            print("Not logged in" if not youtube.current_user() else "Logged in as " + youtube.current_user())
             while menu("What do you want to do?", [("&Download", download),
                                                    # ("&Convert", convert),
-                                                   ("&Logout [logged in as " + youtube.login.username + "]",
-                                                    youtube.logout) if youtube.login.username else
+                                                   ("&Logout [logged in as " + youtube.current_user() + "]",
+                                                    youtube.logout) if youtube.current_user() else
                                                    ("&Login", login)]): pass
             return 0
 